@@ -197,24 +197,27 @@ export async function backfillRun(
   }
 
   for (const e of eligible) {
-    // Use naive local ISO timestamp to match Python's datetime.now().isoformat()
-    const now = new Date()
-      .toLocaleString('sv-SE', { hour12: false })
-      .replace(' ', 'T')
+    // Epoch nanoseconds to match Python's time.time_ns(); kept as a string
+    // because the value exceeds Number's safe integer range
+    const nowNs = (BigInt(Date.now()) * 1_000_000n).toString()
     const markerFile = path.join(debounceDir, `${e.sessionId}.marker`)
 
     try {
+      // Write a new file and rename it over the marker; the worker compares
+      // inode + mtime to detect events that arrived while it was processing
+      const tmpFile = `${markerFile}.${process.pid}.tmp`
       await fs.promises.writeFile(
-        markerFile,
-        JSON.stringify({ start: now, latest: now }),
+        tmpFile,
+        `{"start_ns": ${nowNs}, "latest_ns": ${nowNs}}`,
       )
+      await fs.promises.rename(tmpFile, markerFile)
     } catch {
       // non-fatal
     }
 
     try {
       const workerPath = path.join(env.ROOT_DIR, 'worker.py')
-      const child = spawn('python3', [workerPath, e.sessionId, now], {
+      const child = spawn('python3', [workerPath, e.sessionId, nowNs], {
         detached: true,
         stdio: 'ignore',
       })
@@ -18,10 +18,18 @@ DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql://localhost/workio")
 SCHEMA_PATH = Path(__file__).parent / "schema.sql"
 
 
-def get_db():
-    """Get a database connection."""
+def get_db(synchronous_commit: bool = True):
+    """Get a database connection.
+
+    Pass synchronous_commit=False for writers whose data can be rebuilt (e.g. the
+    transcript worker): commits return without waiting for the WAL flush.
+    """
     conn = psycopg2.connect(DATABASE_URL)
     conn.autocommit = False
+    if not synchronous_commit:
+        cur = conn.cursor()
+        cur.execute("SET synchronous_commit TO OFF")
+        conn.commit()
     return conn
 
 
@@ -63,6 +71,14 @@ def log(conn, message: str, **kwargs) -> None:
     cur.execute('INSERT INTO logs (data) VALUES (%s)', (json.dumps(data),))
 
 
+def log_many(conn, entries: list[dict]) -> None:
+    """Insert several log entries (each a data dict with a "message" key) in one statement."""
+    if not entries:
+        return
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, 'INSERT INTO logs (data) VALUES %s', [(json.dumps(e),) for e in entries])
+
+
 # Hooks
 
 def save_hook(conn, session_id: str, hook_type: str, payload: dict, dedupe_key: str | None = None) -> bool:
@@ -119,19 +135,19 @@ def update_session_metadata(conn, session_id: str, name: str | None, message_cou
     cur = conn.cursor()
     cur.execute('''
         UPDATE sessions SET
-            name = COALESCE(%s, sessions.name),
+            name = COALESCE(LEFT(%s, 200), sessions.name),
             message_count = COALESCE(%s, sessions.message_count)
         WHERE session_id = %s
-    ''', (name[:200] if name else None, message_count, session_id))
+    ''', (name or None, message_count, session_id))
 
 
 def update_session_name_if_empty(conn, session_id: str, name: str) -> None:
     """Update session name only if the current name is empty."""
     cur = conn.cursor()
     cur.execute('''
-        UPDATE sessions SET name = %s
+        UPDATE sessions SET name = LEFT(%s, 200)
         WHERE session_id = %s AND (name IS NULL OR name = '')
-    ''', (name[:200], session_id))
+    ''', (name, session_id))
 
 
 def get_session(conn, session_id: str):
@@ -225,12 +241,24 @@ def update_prompt_text(conn, prompt_id: int, prompt_text: str) -> None:
 # Messages
 
 def message_exists(conn, uuid: str) -> bool:
-    """Check if a message with the given UUID exists."""
+    """Check if a message with the given UUID exists.
+
+    Deprecated: create_message already ignores duplicate UUIDs.
+    """
     cur = conn.cursor()
     cur.execute('SELECT id FROM messages WHERE uuid = %s', (uuid,))
     return cur.fetchone() is not None
 
 
+def get_existing_message_uuids(conn, uuids: list[str]) -> set[str]:
+    """Return the subset of the given UUIDs that already have a message."""
+    if not uuids:
+        return set()
+    cur = conn.cursor()
+    cur.execute('SELECT uuid FROM messages WHERE uuid = ANY(%s)', (uuids,))
+    return {row[0] for row in cur.fetchall()}
+
+
 def create_message(
     conn,
     prompt_id: int,
@@ -243,16 +271,39 @@ def create_message(
     todo_id: str | None = None,
     images: str | None = None
 ) -> int:
-    """Create a new message."""
+    """Create a new message. If the UUID already exists, returns the existing message ID."""
     cur = get_cursor(conn)
     cur.execute('''
         INSERT INTO messages (prompt_id, uuid, created_at, body, thinking, is_user, tools, todo_id, images)
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (uuid) DO NOTHING
         RETURNING id
     ''', (prompt_id, uuid, created_at, body, is_thinking, is_user, tools, todo_id, images))
+    row = cur.fetchone()
+    if row:
+        return row['id']
+    cur.execute('SELECT id FROM messages WHERE uuid = %s', (uuid,))
     return cur.fetchone()['id']
 
 
+def create_messages(conn, rows: list[tuple]) -> dict[str, int]:
+    """Insert many messages in one statement, skipping UUIDs that already exist.
+
+    Each row is (prompt_id, uuid, created_at, body, is_thinking, is_user, tools, todo_id, images).
+    Returns {uuid: id} for the rows that were inserted.
+    """
+    if not rows:
+        return {}
+    cur = get_cursor(conn)
+    inserted = psycopg2.extras.execute_values(cur, '''
+        INSERT INTO messages (prompt_id, uuid, created_at, body, thinking, is_user, tools, todo_id, images)
+        VALUES %s
+        ON CONFLICT (uuid) DO NOTHING
+        RETURNING id, uuid
+    ''', rows, fetch=True)
+    return {row['uuid']: row['id'] for row in inserted}
+
+
 def compute_todo_hash(session_id: str, todos: list[dict]) -> str:
     """Compute MD5 hash from session_id + sorted todo contents.
 
@@ -289,7 +340,8 @@ def upsert_todo_message(
     created_at: str,
     tools: str,
     todos: list[dict],
-    state_key: str
+    state_key: str,
+    todo_hash: str | None = None
 ) -> tuple[int, str, bool, bool]:
     """Upsert a todo message. Returns (message_id, todo_id, is_new, state_changed).
 
@@ -297,10 +349,12 @@ def upsert_todo_message(
     This ensures the same todo list always maps to the same message,
     regardless of prompt_id, tool_use_id, or reprocessing.
 
-    state_key is used to detect when todo statuses have changed.
+    state_key is used to detect when todo statuses have changed. Pass todo_hash
+    when the caller already computed it for these todos.
     """
     # Compute stable hash from session_id + todo contents
-    todo_hash = compute_todo_hash(session_id, todos)
+    if todo_hash is None:
+        todo_hash = compute_todo_hash(session_id, todos)
 
     # Check if a message with this todo_hash already exists
     cur = get_cursor(conn)
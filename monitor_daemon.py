@@ -15,7 +15,7 @@ import socketserver
 import subprocess
 import sys
 import threading
-from datetime import datetime
+import time
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -128,23 +128,26 @@ def start_debounced_worker(session_id: str) -> None:
     DEBOUNCE_DIR.mkdir(exist_ok=True)
 
     marker_file = DEBOUNCE_DIR / f"{session_id}.marker"
-    now = datetime.now().isoformat()
+    now_ns = time.time_ns()
 
-    start_timestamp = now
-    if marker_file.exists():
-        try:
-            data = json.loads(marker_file.read_text())
-            start_timestamp = data.get('start', now)
-        except (json.JSONDecodeError, KeyError):
-            pass
+    start_ns = now_ns
+    try:
+        data = json.loads(marker_file.read_text())
+        start_ns = data.get('start_ns', now_ns)
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
 
-    marker_file.write_text(json.dumps({
-        'start': start_timestamp,
-        'latest': now
+    # Replace rather than rewrite in place: the worker treats an unchanged
+    # inode + mtime as "no new events" when deciding to delete the marker
+    tmp_file = marker_file.with_name(f"{marker_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_file.write_text(json.dumps({
+        'start_ns': start_ns,
+        'latest_ns': now_ns
     }))
+    os.replace(tmp_file, marker_file)
 
     subprocess.Popen(
-        [sys.executable, SCRIPT_DIR / "worker.py", session_id, now],
+        [sys.executable, SCRIPT_DIR / "worker.py", session_id, str(now_ns)],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
         start_new_session=True
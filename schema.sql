@@ -111,8 +111,8 @@ CREATE INDEX IF NOT EXISTS idx_sessions_project_id ON sessions(project_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_shell_id ON sessions(shell_id);
 CREATE INDEX IF NOT EXISTS idx_hooks_session_id ON hooks(session_id);
 CREATE INDEX IF NOT EXISTS idx_hooks_created_at ON hooks(created_at);
-CREATE INDEX IF NOT EXISTS idx_prompts_session_id ON prompts(session_id);
-CREATE INDEX IF NOT EXISTS idx_messages_prompt_id ON messages(prompt_id);
+CREATE INDEX IF NOT EXISTS idx_prompts_session_id_id ON prompts(session_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_prompt_user_id ON messages(prompt_id, is_user, id DESC);
 CREATE INDEX IF NOT EXISTS idx_messages_todo_id ON messages(todo_id);
 CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
 CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs(created_at);
@@ -3,37 +3,70 @@ Shared test fixtures for WorkIO tests.
 """
 
 import json
-import tempfile
-from pathlib import Path
+import os
+import shutil
 from unittest.mock import patch
 
 import pytest
 
+# Tables emptied between tests
+DB_TABLES = ('messages', 'prompts', 'hooks', 'logs', 'sessions', 'projects')
 
-@pytest.fixture
-def temp_dir():
-    """Create a temporary directory for test files."""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        yield Path(tmpdir)
+# Tests create the schema and wipe tables, so they only run against a
+# PostgreSQL database set aside for them - never the DATABASE_URL in .env
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
 
 
-@pytest.fixture
-def db_conn(temp_dir):
-    """Create a fresh database connection using db module with temp path."""
-    db_path = temp_dir / "test.db"
+@pytest.fixture(scope="module")
+def temp_dir(tmp_path_factory):
+    """Create a temporary directory for test files, shared by a test module."""
+    return tmp_path_factory.mktemp("workio")
+
 
-    # Patch DB_PATH before importing/using db module
-    with patch("db.DB_PATH", db_path):
+@pytest.fixture(scope="module")
+def module_db():
+    """Create the schema once per test module in the PostgreSQL test database.
+
+    db.DATABASE_URL stays patched for the whole module, so connections opened
+    by the code under test (get_db) go to the test database too.
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
+    with patch("db.DATABASE_URL", TEST_DATABASE_URL):
         from db import init_db
         conn = init_db()
+        # Test data is disposable: don't wait for the WAL flush on every commit
+        cur = conn.cursor()
+        cur.execute("SET synchronous_commit TO OFF")
+        conn.commit()
         yield conn
         conn.close()
 
 
+@pytest.fixture
+def db_conn(module_db):
+    """Provide the module's database connection with all rows removed and ids reset."""
+    # A failed test may leave its transaction aborted
+    module_db.rollback()
+    cur = module_db.cursor()
+    cur.execute(f"TRUNCATE {', '.join(DB_TABLES)} RESTART IDENTITY CASCADE")
+    module_db.commit()
+    yield module_db
+
+
+@pytest.fixture
+def tx(db_conn):
+    """Yield the database connection inside a single transaction, committed on exit."""
+    with db_conn:
+        yield db_conn
+
+
 @pytest.fixture
 def debounce_dir(temp_dir):
     """Create a temporary debounce directory."""
     debounce = temp_dir / "debounce"
+    shutil.rmtree(debounce, ignore_errors=True)
     debounce.mkdir()
     yield debounce
 
@@ -50,9 +83,9 @@ def sample_hook_event():
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def sample_transcript(temp_dir):
-    """Create a sample transcript file."""
+    """Create a sample transcript file once per module; tests only read it."""
     transcript_path = temp_dir / "transcript.jsonl"
 
     entries = [
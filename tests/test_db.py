@@ -2,51 +2,69 @@
 Tests for database functions in db.py
 """
 
-import json
-import pytest
-import sys
-from pathlib import Path
-
-# Add parent directory to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
 from db import (
-    log, save_hook,
+    log, log_many, save_hook,
     upsert_project,
     upsert_session, update_session_metadata, get_session,
     get_session_project_path,
     get_stale_session_ids, delete_sessions_cascade,
     create_prompt, get_latest_prompt, update_prompt_text,
-    message_exists, create_message, get_latest_user_message
+    message_exists, create_message, create_messages, get_existing_message_uuids,
+    get_latest_user_message, get_cursor
 )
 
 
+def query_one(conn, sql: str, params: tuple = ()) -> dict | None:
+    """Run a query and return its first row as a dict."""
+    cur = get_cursor(conn)
+    cur.execute(sql, params)
+    return cur.fetchone()
+
+
+def create_session_prompt(conn, session_id: str = "session-1") -> int:
+    """Create a project, session and prompt so message rows satisfy their foreign keys."""
+    project_id = upsert_project(conn, "/test")
+    upsert_session(conn, session_id, project_id, "active", "")
+    return create_prompt(conn, session_id)
+
+
 class TestLogs:
     """Tests for logging functions."""
 
     def test_log_creates_entry(self, db_conn):
         """Test that log creates a log entry."""
-        log(db_conn, "Test message", key="value")
-        db_conn.commit()
+        with db_conn:
+            log(db_conn, "Test message", key="value")
 
-        row = db_conn.execute('SELECT data FROM logs').fetchone()
-        data = json.loads(row['data'])
+        data = query_one(db_conn, 'SELECT data FROM logs')['data']
 
         assert data['message'] == "Test message"
         assert data['key'] == "value"
 
     def test_log_multiple_kwargs(self, db_conn):
         """Test log with multiple kwargs."""
-        log(db_conn, "Test", a=1, b="two", c=True)
-        db_conn.commit()
+        with db_conn:
+            log(db_conn, "Test", a=1, b="two", c=True)
 
-        row = db_conn.execute('SELECT data FROM logs').fetchone()
-        data = json.loads(row['data'])
+        data = query_one(db_conn, 'SELECT data FROM logs')['data']
 
         assert data['a'] == 1
         assert data['b'] == "two"
         assert data['c'] is True
 
+    def test_log_many(self, db_conn):
+        """Test that log_many writes every entry in order."""
+        with db_conn:
+            log_many(db_conn, [{"message": "First", "n": 1}, {"message": "Second", "n": 2}])
+            log_many(db_conn, [])
+
+        cur = get_cursor(db_conn)
+        cur.execute('SELECT data FROM logs ORDER BY id')
+        assert [row['data'] for row in cur.fetchall()] == [
+            {"message": "First", "n": 1},
+            {"message": "Second", "n": 2},
+        ]
+
 
 class TestHooks:
     """Tests for hook functions."""
@@ -54,13 +72,23 @@ class TestHooks:
     def test_save_hook(self, db_conn):
         """Test saving a hook event."""
         payload = {"event": "test", "data": 123}
-        save_hook(db_conn, "session-1", "TestHook", payload)
+        with db_conn:
+            inserted = save_hook(db_conn, "session-1", "TestHook", payload)
+        assert inserted is True
+
+        row = query_one(db_conn, 'SELECT session_id, hook_type, payload FROM hooks')
 
-        row = db_conn.execute('SELECT * FROM hooks').fetchone()
+        assert (row['session_id'], row['hook_type']) == ("session-1", "TestHook")
+        assert row['payload'] == payload
 
-        assert row['session_id'] == "session-1"
-        assert row['hook_type'] == "TestHook"
-        assert json.loads(row['payload']) == payload
+    def test_save_hook_dedupe_key(self, db_conn):
+        """Test that a repeated dedupe_key is not stored twice."""
+        with db_conn:
+            first = save_hook(db_conn, "session-1", "TestHook", {}, dedupe_key="key-1")
+            second = save_hook(db_conn, "session-1", "TestHook", {}, dedupe_key="key-1")
+        assert (first, second) == (True, False)
+
+        assert query_one(db_conn, 'SELECT COUNT(*) AS count FROM hooks')['count'] == 1
 
 
 class TestProjects:
@@ -68,11 +96,12 @@ class TestProjects:
 
     def test_upsert_project_creates_new(self, db_conn):
         """Test creating a new project."""
-        project_id = upsert_project(db_conn, "/test/path")
+        with db_conn:
+            project_id = upsert_project(db_conn, "/test/path")
 
         assert project_id == 1
 
-        row = db_conn.execute('SELECT * FROM projects WHERE id = ?', (project_id,)).fetchone()
+        row = query_one(db_conn, 'SELECT path FROM projects WHERE id = %s', (project_id,))
         assert row['path'] == "/test/path"
 
     def test_upsert_project_returns_existing(self, db_conn):
@@ -89,28 +118,30 @@ class TestProjects:
 
         assert id1 != id2
 
+
 class TestSessions:
     """Tests for session functions."""
 
     def test_upsert_session_creates_new(self, db_conn):
         """Test creating a new session."""
-        upsert_session(db_conn, "session-1", 1, "started", "/transcript.jsonl")
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, "/test")
+            upsert_session(db_conn, "session-1", project_id, "started", "/transcript.jsonl")
 
-        row = db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
-        assert row['project_id'] == 1
-        assert row['status'] == "started"
-        assert row['transcript_path'] == "/transcript.jsonl"
+        row = query_one(
+            db_conn, 'SELECT project_id, status, transcript_path FROM sessions WHERE session_id = %s', ("session-1",)
+        )
+        assert (row['project_id'], row['status'], row['transcript_path']) == (project_id, "started", "/transcript.jsonl")
 
     def test_upsert_session_updates_existing(self, db_conn):
         """Test updating an existing session."""
-        upsert_session(db_conn, "session-1", 1, "started", "/old.jsonl")
-        upsert_session(db_conn, "session-1", 1, "active", "/new.jsonl")
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, "/test")
+            upsert_session(db_conn, "session-1", project_id, "started", "/old.jsonl")
+            upsert_session(db_conn, "session-1", project_id, "active", "/new.jsonl")
 
-        row = db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
-        assert row['status'] == "active"
-        assert row['transcript_path'] == "/new.jsonl"
+        row = query_one(db_conn, 'SELECT status, transcript_path FROM sessions WHERE session_id = %s', ("session-1",))
+        assert (row['status'], row['transcript_path']) == ("active", "/new.jsonl")
 
     def test_upsert_session_does_not_update_project_id(self, db_conn):
         """Test that project_id is NOT updated when session already exists.
@@ -125,25 +156,24 @@ class TestSessions:
 
         original_project_id = upsert_project(db_conn, original_path)
         new_project_id = upsert_project(db_conn, new_path)
-        db_conn.commit()
 
         # Verify they are different projects
         assert original_project_id != new_project_id
 
         # First hook: session created with original path
-        upsert_session(db_conn, "session-1", original_project_id, "started", "/transcript.jsonl")
-        db_conn.commit()
+        with db_conn:
+            upsert_session(db_conn, "session-1", original_project_id, "started", "/transcript.jsonl")
 
         # Verify session has original project_id
-        row = db_conn.execute('SELECT project_id FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
+        row = query_one(db_conn, 'SELECT project_id FROM sessions WHERE session_id = %s', ("session-1",))
         assert row['project_id'] == original_project_id
 
         # Second hook: same session but Claude changed to subdirectory
-        upsert_session(db_conn, "session-1", new_project_id, "active", "/transcript.jsonl")
-        db_conn.commit()
+        with db_conn:
+            upsert_session(db_conn, "session-1", new_project_id, "active", "/transcript.jsonl")
 
         # Verify project_id was NOT updated - should still be original
-        row = db_conn.execute('SELECT project_id FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
+        row = query_one(db_conn, 'SELECT project_id FROM sessions WHERE session_id = %s', ("session-1",))
         assert row['project_id'] == original_project_id, "project_id should not change after session creation"
 
         # Verify get_session_project_path returns the original path
@@ -152,9 +182,9 @@ class TestSessions:
 
     def test_get_session_project_path(self, db_conn):
         """Test getting the stored project path for a session."""
-        project_id = upsert_project(db_conn, "/my/project/path")
-        upsert_session(db_conn, "session-1", project_id, "active", "")
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, "/my/project/path")
+            upsert_session(db_conn, "session-1", project_id, "active", "")
 
         path = get_session_project_path(db_conn, "session-1")
         assert path == "/my/project/path"
@@ -166,33 +196,42 @@ class TestSessions:
 
     def test_update_session_metadata(self, db_conn):
         """Test updating session metadata."""
-        upsert_session(db_conn, "session-1", 1, "started", "")
-        update_session_metadata(db_conn, "session-1", "My Session", "main", 10)
-        db_conn.commit()
+        with db_conn:
+            create_session_prompt(db_conn)
+            update_session_metadata(db_conn, "session-1", "My Session", 10)
+
+        row = query_one(db_conn, 'SELECT name, message_count FROM sessions WHERE session_id = %s', ("session-1",))
+        assert (row['name'], row['message_count']) == ("My Session", 10)
+
+    def test_update_session_metadata_keeps_values_when_null(self, db_conn):
+        """Test that NULL name and message_count leave the stored values alone."""
+        with db_conn:
+            create_session_prompt(db_conn)
+            update_session_metadata(db_conn, "session-1", "My Session", 10)
+            update_session_metadata(db_conn, "session-1", None, None)
 
-        row = db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
-        assert row['name'] == "My Session"
-        assert row['git_branch'] == "main"
-        assert row['message_count'] == 10
+        row = query_one(db_conn, 'SELECT name, message_count FROM sessions WHERE session_id = %s', ("session-1",))
+        assert (row['name'], row['message_count']) == ("My Session", 10)
 
     def test_update_session_metadata_truncates_long_name(self, db_conn):
         """Test that long names are truncated to 200 chars."""
-        upsert_session(db_conn, "session-1", 1, "started", "")
-        long_name = "x" * 300
-        update_session_metadata(db_conn, "session-1", long_name, None, None)
-        db_conn.commit()
+        with db_conn:
+            create_session_prompt(db_conn)
+            update_session_metadata(db_conn, "session-1", "x" * 300, None)
 
-        row = db_conn.execute('SELECT name FROM sessions WHERE session_id = ?', ("session-1",)).fetchone()
+        row = query_one(db_conn, 'SELECT name FROM sessions WHERE session_id = %s', ("session-1",))
         assert len(row['name']) == 200
 
     def test_get_session(self, db_conn):
         """Test getting a session by ID."""
-        upsert_session(db_conn, "session-1", 1, "active", "/transcript.jsonl")
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, "/test")
+            upsert_session(db_conn, "session-1", project_id, "active", "/transcript.jsonl")
 
         session = get_session(db_conn, "session-1")
         assert session is not None
         assert session['status'] == "active"
+        assert session['transcript_path'] == "/transcript.jsonl"
 
     def test_get_session_not_found(self, db_conn):
         """Test getting a non-existent session."""
@@ -202,14 +241,14 @@ class TestSessions:
     def test_get_stale_session_ids(self, db_conn):
         """Test getting stale session IDs."""
         # Create project and sessions
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "current", 1, "started", "")
-        upsert_session(db_conn, "stale-1", 1, "started", "")
-        upsert_session(db_conn, "stale-2", 1, "started", "")
-        upsert_session(db_conn, "active", 1, "active", "")  # Not stale - different status
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, "/test")
+            upsert_session(db_conn, "current", project_id, "started", "")
+            upsert_session(db_conn, "stale-1", project_id, "started", "")
+            upsert_session(db_conn, "stale-2", project_id, "started", "")
+            upsert_session(db_conn, "active", project_id, "active", "")  # Not stale - different status
 
-        stale_ids = get_stale_session_ids(db_conn, 1, "current")
+        stale_ids = get_stale_session_ids(db_conn, project_id, "current")
 
         assert "stale-1" in stale_ids
         assert "stale-2" in stale_ids
@@ -219,25 +258,22 @@ class TestSessions:
     def test_delete_sessions_cascade(self, db_conn):
         """Test cascading delete of sessions."""
         # Setup data
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "session-1", 1, "started", "")
-        upsert_session(db_conn, "session-2", 1, "started", "")
-
-        prompt_id = create_prompt(db_conn, "session-1", "test prompt")
-        create_message(db_conn, prompt_id, "msg-1", "2024-01-01", "Hello", False, True)
-        save_hook(db_conn, "session-1", "TestHook", {})
-        db_conn.commit()
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn, "session-1")
+            create_session_prompt(db_conn, "session-2")
+            create_message(db_conn, prompt_id, "msg-1", "2024-01-01", "Hello", False, True)
+            save_hook(db_conn, "session-1", "TestHook", {})
 
         # Delete session-1
-        delete_sessions_cascade(db_conn, ["session-1"])
-        db_conn.commit()
+        with db_conn:
+            delete_sessions_cascade(db_conn, ["session-1"])
 
         # Verify cascade
         assert get_session(db_conn, "session-1") is None
         assert get_session(db_conn, "session-2") is not None
-        assert db_conn.execute('SELECT COUNT(*) FROM prompts WHERE session_id = ?', ("session-1",)).fetchone()[0] == 0
-        assert db_conn.execute('SELECT COUNT(*) FROM messages WHERE prompt_id = ?', (prompt_id,)).fetchone()[0] == 0
-        assert db_conn.execute('SELECT COUNT(*) FROM hooks WHERE session_id = ?', ("session-1",)).fetchone()[0] == 0
+        assert query_one(db_conn, 'SELECT 1 FROM prompts WHERE session_id = %s LIMIT 1', ("session-1",)) is None
+        assert query_one(db_conn, 'SELECT 1 FROM messages WHERE prompt_id = %s LIMIT 1', (prompt_id,)) is None
+        assert query_one(db_conn, 'SELECT 1 FROM hooks WHERE session_id = %s LIMIT 1', ("session-1",)) is None
 
     def test_delete_sessions_cascade_empty_list(self, db_conn):
         """Test that empty list doesn't cause errors."""
@@ -249,24 +285,28 @@ class TestPrompts:
 
     def test_create_prompt_with_text(self, db_conn):
         """Test creating a prompt with text."""
-        prompt_id = create_prompt(db_conn, "session-1", "Hello world")
+        with db_conn:
+            create_session_prompt(db_conn)
+            prompt_id = create_prompt(db_conn, "session-1", "Hello world")
 
-        row = db_conn.execute('SELECT * FROM prompts WHERE id = ?', (prompt_id,)).fetchone()
-        assert row['session_id'] == "session-1"
-        assert row['prompt'] == "Hello world"
+        row = query_one(db_conn, 'SELECT session_id, prompt FROM prompts WHERE id = %s', (prompt_id,))
+        assert (row['session_id'], row['prompt']) == ("session-1", "Hello world")
 
     def test_create_prompt_without_text(self, db_conn):
         """Test creating a prompt without text."""
-        prompt_id = create_prompt(db_conn, "session-1")
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
 
-        row = db_conn.execute('SELECT * FROM prompts WHERE id = ?', (prompt_id,)).fetchone()
+        row = query_one(db_conn, 'SELECT prompt FROM prompts WHERE id = %s', (prompt_id,))
         assert row['prompt'] is None
 
     def test_get_latest_prompt(self, db_conn):
         """Test getting the latest prompt."""
-        create_prompt(db_conn, "session-1", "First")
-        create_prompt(db_conn, "session-1", "Second")
-        create_prompt(db_conn, "session-1", "Third")
+        with db_conn:
+            create_session_prompt(db_conn)
+            create_prompt(db_conn, "session-1", "First")
+            create_prompt(db_conn, "session-1", "Second")
+            create_prompt(db_conn, "session-1", "Third")
 
         latest = get_latest_prompt(db_conn, "session-1")
         assert latest['prompt'] == "Third"
@@ -278,11 +318,11 @@ class TestPrompts:
 
     def test_update_prompt_text(self, db_conn):
         """Test updating prompt text."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        update_prompt_text(db_conn, prompt_id, "Updated text")
-        db_conn.commit()
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            update_prompt_text(db_conn, prompt_id, "Updated text")
 
-        row = db_conn.execute('SELECT prompt FROM prompts WHERE id = ?', (prompt_id,)).fetchone()
+        row = query_one(db_conn, 'SELECT prompt FROM prompts WHERE id = %s', (prompt_id,))
         assert row['prompt'] == "Updated text"
 
 
@@ -291,8 +331,9 @@ class TestMessages:
 
     def test_message_exists_true(self, db_conn):
         """Test message_exists returns True for existing message."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        create_message(db_conn, prompt_id, "uuid-123", "2024-01-01", "Hello", False, True)
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            create_message(db_conn, prompt_id, "uuid-123", "2024-01-01", "Hello", False, True)
 
         assert message_exists(db_conn, "uuid-123") is True
 
@@ -300,39 +341,83 @@ class TestMessages:
         """Test message_exists returns False for non-existing message."""
         assert message_exists(db_conn, "nonexistent") is False
 
+    def test_get_existing_message_uuids(self, db_conn):
+        """Test that only stored UUIDs are returned."""
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Hello", False, True)
+            create_message(db_conn, prompt_id, "uuid-3", "2024-01-01", "Reply", False, False)
+
+        assert get_existing_message_uuids(db_conn, ["uuid-1", "uuid-2", "uuid-3"]) == {"uuid-1", "uuid-3"}
+        assert get_existing_message_uuids(db_conn, ["uuid-2"]) == set()
+        assert get_existing_message_uuids(db_conn, []) == set()
+
     def test_create_message_user(self, db_conn):
         """Test creating a user message."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        msg_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01T10:00:00", "Hello", False, True)
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            msg_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01T10:00:00", "Hello", False, True)
 
-        row = db_conn.execute('SELECT * FROM messages WHERE id = ?', (msg_id,)).fetchone()
-        assert row['body'] == "Hello"
-        assert row['is_user'] == 1
-        assert row['thinking'] == 0
+        row = query_one(db_conn, 'SELECT body, is_user, thinking FROM messages WHERE id = %s', (msg_id,))
+        assert (row['body'], row['is_user'], row['thinking']) == ("Hello", True, False)
 
     def test_create_message_assistant_thinking(self, db_conn):
         """Test creating an assistant thinking message."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        msg_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Thinking...", True, False)
-
-        row = db_conn.execute('SELECT * FROM messages WHERE id = ?', (msg_id,)).fetchone()
-        assert row['thinking'] == 1
-        assert row['is_user'] == 0
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            msg_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Thinking...", True, False)
+
+        row = query_one(db_conn, 'SELECT thinking, is_user FROM messages WHERE id = %s', (msg_id,))
+        assert (row['thinking'], row['is_user']) == (True, False)
+
+    def test_create_message_duplicate_returns_existing_id(self, db_conn):
+        """Test that a repeated UUID returns the stored message's id."""
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            msg_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Hello", False, True)
+            duplicate_id = create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Again", False, True)
+
+        assert duplicate_id == msg_id
+        assert query_one(db_conn, 'SELECT body FROM messages WHERE id = %s', (msg_id,))['body'] == "Hello"
+
+    def test_create_messages_skips_existing(self, db_conn):
+        """Test bulk insert returns ids only for newly inserted UUIDs."""
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Existing", False, True)
+            ids = create_messages(db_conn, [
+                (prompt_id, "uuid-1", "2024-01-01", "Duplicate", False, True, None, None, None),
+                (prompt_id, "uuid-2", "2024-01-01", "Reply", False, False, '{"name": "Bash"}', None, None),
+                (prompt_id, "uuid-2", "2024-01-01", "Repeated in batch", False, False, None, None, None),
+            ])
+
+        cur = get_cursor(db_conn)
+        cur.execute('SELECT id, uuid, body, tools FROM messages ORDER BY id')
+        rows = cur.fetchall()
+        assert [(row['uuid'], row['body']) for row in rows] == [("uuid-1", "Existing"), ("uuid-2", "Reply")]
+        assert ids == {"uuid-2": rows[1]['id']}
+        assert rows[1]['tools'] == {"name": "Bash"}
+
+    def test_create_messages_empty(self, db_conn):
+        """Test that an empty batch inserts nothing."""
+        assert create_messages(db_conn, []) == {}
 
     def test_get_latest_user_message(self, db_conn):
         """Test getting the latest user message."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "First user msg", False, True)
-        create_message(db_conn, prompt_id, "uuid-2", "2024-01-01", "Assistant reply", False, False)
-        create_message(db_conn, prompt_id, "uuid-3", "2024-01-01", "Second user msg", False, True)
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "First user msg", False, True)
+            create_message(db_conn, prompt_id, "uuid-2", "2024-01-01", "Assistant reply", False, False)
+            create_message(db_conn, prompt_id, "uuid-3", "2024-01-01", "Second user msg", False, True)
 
         latest = get_latest_user_message(db_conn, prompt_id)
         assert latest['body'] == "Second user msg"
 
     def test_get_latest_user_message_no_user_messages(self, db_conn):
         """Test getting latest user message when none exist."""
-        prompt_id = create_prompt(db_conn, "session-1")
-        create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Assistant only", False, False)
+        with db_conn:
+            prompt_id = create_session_prompt(db_conn)
+            create_message(db_conn, prompt_id, "uuid-1", "2024-01-01", "Assistant only", False, False)
 
         latest = get_latest_user_message(db_conn, prompt_id)
         assert latest is None
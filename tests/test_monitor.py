@@ -1,166 +1,200 @@
 """
-Tests for monitor.py
+Tests for monitor.py and monitor_daemon.py
 """
 
 import json
 import io
-import sys
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
+import psycopg2.extras
 import pytest
 
-sys.path.insert(0, str(Path(__file__).parent.parent))
+from db import get_cursor, get_session, upsert_project, upsert_session, get_session_project_path
+from monitor import main
+from monitor_daemon import clean_sessions, get_session_index_entry, process_event
+
+# Shared assertion queries, selecting only the columns the tests check
+_SESSION_BY_ID = 'SELECT status, project_id FROM sessions WHERE session_id = %s'
+_PROMPT_BY_SID = 'SELECT id, prompt FROM prompts WHERE session_id = %s ORDER BY id'
+_HOOK_BY_SID = 'SELECT hook_type, payload FROM hooks WHERE session_id = %s ORDER BY id'
+_INSERT_SESSION = 'INSERT INTO sessions (session_id, project_id, status) VALUES (%s, %s, %s)'
+_LATEST_LOG = 'SELECT data FROM logs ORDER BY id DESC LIMIT 1'
+
+
+@contextmanager
+def daemon_env(conn, home: Path, **overrides):
+    """Run monitor_daemon.process_event on the test connection with its side effects stubbed.
+
+    The daemon's persistent connection is replaced by conn and HOME points at
+    home, so ~/.claude lookups find only what a test writes there. Worker and
+    cleanup spawning are stubbed by default; pass keyword overrides to replace
+    another monitor_daemon attribute. Yields the dict of installed mocks.
+    """
+    mocks = {
+        'start_debounced_worker': MagicMock(),
+        'start_cleanup_worker': MagicMock(),
+        **overrides,
+    }
+    with ExitStack() as stack:
+        stack.enter_context(patch.dict('os.environ', {'HOME': str(home)}))
+        stack.enter_context(patch.multiple('monitor_daemon', _db_conn=conn, **mocks))
+        yield mocks
+
+
+def query(conn, sql: str, params: tuple = ()) -> list[dict]:
+    """Run a query and return its rows as dicts."""
+    cur = get_cursor(conn)
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+def assert_state(conn, session_id: str, **expect) -> dict:
+    """Fetch a session with its first prompt and hook in one query and check fields.
+
+    Returns the row as a dict (status, project_id, prompt_id, hook_type) so
+    callers can make further assertions.
+    """
+    rows = query(conn, '''
+        SELECT s.status, s.project_id, p.id AS prompt_id, h.hook_type
+        FROM sessions s
+        LEFT JOIN prompts p ON p.session_id = s.session_id
+        LEFT JOIN hooks h ON h.session_id = s.session_id
+        WHERE s.session_id = %s
+        ORDER BY p.id, h.id
+        LIMIT 1
+    ''', (session_id,))
+    assert rows, f"Session {session_id} not found"
+    state = rows[0]
+    for key, value in expect.items():
+        assert state[key] == value, f"{key}: expected {value!r}, got {state[key]!r}"
+    return state
 
 
 class TestMonitorMain:
-    """Tests for the main monitor function."""
+    """Tests for the thin client in monitor.py."""
 
     def test_invalid_json_continues(self, capsys):
         """Test that invalid JSON input returns continue: True."""
         with patch('sys.stdin', io.StringIO("not valid json")):
-            from monitor import main
             main()
 
         captured = capsys.readouterr()
         output = json.loads(captured.out)
         assert output["continue"] is True
 
-    def test_session_start_creates_session(self, db_conn, temp_dir, capsys):
-        """Test that SessionStart hook creates a session and prompt."""
-        db_path = temp_dir / "test.db"
-
-        event = {
-            "session_id": "test-session",
-            "cwd": "/test/project",
-            "hook_event_name": "SessionStart",
-            "transcript_path": "/tmp/transcript.jsonl"
-        }
+    def test_daemon_not_running_continues(self, temp_dir, capsys):
+        """Test that the hook is not blocked when the daemon socket is missing."""
+        event = {"session_id": "test-session", "hook_event_name": "Stop"}
 
         with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.start_debounced_worker'), \
-             patch('monitor.notify'):
-            from monitor import main
+             patch('monitor.SOCKET_PATH', str(temp_dir / "missing.sock")):
             main()
 
-        # Check session was created
-        session = db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("test-session",)).fetchone()
-        assert session is not None
-        assert session['status'] == "started"
-
-        # Check prompt was created
-        prompt = db_conn.execute('SELECT * FROM prompts WHERE session_id = ?', ("test-session",)).fetchone()
-        assert prompt is not None
-
-        # Check output
-        captured = capsys.readouterr()
-        output = json.loads(captured.out)
+        output = json.loads(capsys.readouterr().out)
         assert output["continue"] is True
 
-    def test_user_prompt_submit_creates_prompt(self, db_conn, temp_dir, capsys):
-        """Test that UserPromptSubmit creates a prompt with text."""
-        db_path = temp_dir / "test.db"
 
-        # First create a session
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test/project")')
-        db_conn.execute('INSERT INTO sessions (session_id, project_id, status) VALUES (?, ?, ?)',
-                       ("test-session", 1, "started"))
-        db_conn.commit()
+class TestProcessEvent:
+    """Tests for hook handling in monitor_daemon.process_event."""
 
+    def test_notification_permission_prompt(self, db_conn, temp_dir):
+        """Test that permission_prompt sets the status and notifies the frontend."""
         event = {
             "session_id": "test-session",
             "cwd": "/test/project",
-            "hook_event_name": "UserPromptSubmit",
-            "prompt": "Hello, world!",
-            "transcript_path": "/tmp/transcript.jsonl"
+            "hook_event_name": "Notification",
+            "notification_type": "permission_prompt"
         }
 
-        with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.start_debounced_worker'), \
-             patch('monitor.get_session_index_entry', return_value=None):
-            from monitor import main
-            main()
+        with daemon_env(db_conn, temp_dir, notify=MagicMock()) as mocks:
+            process_event(event, {})
+
+        assert_state(db_conn, "test-session", status="permission_needed")
+        mocks['notify'].assert_called_once()
+        channel, payload = mocks['notify'].call_args[0][1:]
+        assert channel == "hook"
+        assert (payload['hook_type'], payload['status']) == ("Notification", "permission_needed")
+
+    def test_workers_started_after_commit(self, db_conn, temp_dir):
+        """Test that every hook schedules the transcript worker and only later hooks the cleanup."""
+        event = {"session_id": "test-session", "cwd": "/test/project", "transcript_path": ""}
 
-        # Check prompt was created with text
-        prompt = db_conn.execute('SELECT * FROM prompts WHERE session_id = ? AND prompt = ?',
-                                ("test-session", "Hello, world!")).fetchone()
-        assert prompt is not None
+        with daemon_env(db_conn, temp_dir) as mocks:
+            process_event({**event, "hook_event_name": "SessionStart"}, {})
+            mocks['start_debounced_worker'].assert_called_once_with("test-session")
+            mocks['start_cleanup_worker'].assert_not_called()
 
-    def test_hook_event_saved(self, db_conn, temp_dir, capsys):
-        """Test that hook events are saved to hooks table."""
-        db_path = temp_dir / "test.db"
+            process_event({**event, "hook_event_name": "Stop"}, {})
+            assert mocks['start_debounced_worker'].call_count == 2
+            mocks['start_cleanup_worker'].assert_called_once_with()
 
+    def test_error_handling_logs_error(self, db_conn, temp_dir):
+        """Test that errors are logged and the hook is still acknowledged."""
         event = {
             "session_id": "test-session",
             "cwd": "/test/project",
-            "hook_event_name": "PreToolUse",
-            "tool_name": "Read"
+            "hook_event_name": "SessionStart"
         }
 
-        with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.start_debounced_worker'):
-            from monitor import main
-            main()
+        with daemon_env(db_conn, temp_dir, upsert_project=MagicMock(side_effect=ValueError("Test error"))) as mocks:
+            assert process_event(event, {}) == {"continue": True}
 
-        # Check hook was saved
-        hook = db_conn.execute('SELECT * FROM hooks WHERE session_id = ?', ("test-session",)).fetchone()
-        assert hook is not None
-        assert hook['hook_type'] == "PreToolUse"
-        payload = json.loads(hook['payload'])
-        assert payload['tool_name'] == "Read"
+        # Nothing is scheduled for a hook that failed to process
+        mocks['start_debounced_worker'].assert_not_called()
 
-    def test_notification_permission_prompt(self, db_conn, temp_dir, capsys):
-        """Test that permission_prompt triggers notification."""
-        db_path = temp_dir / "test.db"
+        # Check error was logged
+        data = query(db_conn, _LATEST_LOG)[0]['data']
+        assert data['message'] == "Daemon processing error"
+        assert data['error'] == "Test error"
 
-        event = {
+
+class TestSessionLifecycle:
+    """Runs one session through its hook events against a single database."""
+
+    def test_full_flow(self, db_conn, temp_dir):
+        """Test SessionStart -> UserPromptSubmit -> PreToolUse -> Stop -> SessionEnd."""
+        base = {
             "session_id": "test-session",
             "cwd": "/test/project",
-            "hook_event_name": "Notification",
-            "notification_type": "permission_prompt"
+            "transcript_path": str(temp_dir / "transcript.jsonl")
         }
 
-        mock_notify = MagicMock()
+        with daemon_env(db_conn, temp_dir):
+            # SessionStart creates the session and its first prompt
+            response = process_event({**base, "hook_event_name": "SessionStart"}, {})
 
-        with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.start_debounced_worker'), \
-             patch('monitor.notify', mock_notify):
-            from monitor import main
-            main()
+            assert response["continue"] is True
+            state = assert_state(db_conn, "test-session", status="started", hook_type="SessionStart")
+            assert state['prompt_id'] is not None
 
-        # Check notification was called
-        mock_notify.assert_called_once_with("project", "Permission Request")
+            # UserPromptSubmit stores the prompt text and names the session after it
+            process_event({**base, "hook_event_name": "UserPromptSubmit", "prompt": "Hello, world!"}, {})
 
-    def test_error_handling_logs_error(self, db_conn, temp_dir, capsys):
-        """Test that errors are logged and re-raised."""
-        db_path = temp_dir / "test.db"
+            prompts = query(db_conn, _PROMPT_BY_SID, ("test-session",))
+            assert [row['prompt'] for row in prompts] == [None, "Hello, world!"]
+            assert_state(db_conn, "test-session", status="active")
+            assert get_session(db_conn, "test-session")['name'] == "Hello, world!"
 
-        event = {
-            "session_id": "test-session",
-            "cwd": "/test/project",
-            "hook_event_name": "SessionStart"
-        }
+            # PreToolUse is saved to the hooks table
+            process_event({**base, "hook_event_name": "PreToolUse", "tool_name": "Read"}, {})
 
-        def raise_error(*args, **kwargs):
-            raise ValueError("Test error")
+            hooks = query(db_conn, _HOOK_BY_SID, ("test-session",))
+            pre_tool = [row for row in hooks if row['hook_type'] == "PreToolUse"]
+            assert len(pre_tool) == 1
+            assert pre_tool[0]['payload']['tool_name'] == "Read"
 
-        with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.upsert_project', side_effect=raise_error):
+            # Stop and SessionEnd move the session to its final statuses
+            process_event({**base, "hook_event_name": "Stop"}, {})
+            assert_state(db_conn, "test-session", status="done")
 
-            with pytest.raises(RuntimeError, match="WorkIO Error"):
-                from monitor import main
-                main()
+            process_event({**base, "hook_event_name": "SessionEnd"}, {})
+            assert_state(db_conn, "test-session", status="ended")
 
-        # Check error was logged
-        log_entry = db_conn.execute('SELECT data FROM logs ORDER BY id DESC LIMIT 1').fetchone()
-        if log_entry:
-            data = json.loads(log_entry['data'])
-            assert "error" in data or data.get('message') == "Monitor error"
+        assert [row['hook_type'] for row in query(db_conn, _HOOK_BY_SID, ("test-session",))] == [
+            "SessionStart", "UserPromptSubmit", "PreToolUse", "Stop", "SessionEnd"
+        ]
 
 
 class TestStatusMapping:
@@ -174,10 +208,8 @@ class TestStatusMapping:
         ("Stop", "done"),
         ("SessionEnd", "ended"),
     ])
-    def test_hook_type_to_status(self, db_conn, temp_dir, hook_type, expected_status, capsys):
+    def test_hook_type_to_status(self, db_conn, temp_dir, hook_type, expected_status):
         """Test that hook types map to correct statuses."""
-        db_path = temp_dir / "test.db"
-
         event = {
             "session_id": "test-session",
             "cwd": "/test/project",
@@ -185,38 +217,26 @@ class TestStatusMapping:
             "transcript_path": ""
         }
 
-        with patch('sys.stdin', io.StringIO(json.dumps(event))), \
-             patch('db.DB_PATH', db_path), \
-             patch('monitor.start_debounced_worker'), \
-             patch('monitor.get_session_index_entry', return_value=None):
-            from monitor import main
-            main()
+        with daemon_env(db_conn, temp_dir):
+            assert process_event(event, {}) == {"continue": True}
 
-        session = db_conn.execute('SELECT status FROM sessions WHERE session_id = ?', ("test-session",)).fetchone()
-        assert session['status'] == expected_status
+        assert_state(db_conn, "test-session", status=expected_status)
 
 
 class TestCleanSessions:
     """Tests for session cleanup."""
 
-    def test_clean_sessions_removes_stale(self, db_conn):
+    def test_clean_sessions_removes_stale(self, tx):
         """Test that stale sessions are cleaned up."""
-        from monitor import clean_sessions
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        db_conn.execute('INSERT INTO sessions (session_id, project_id, status) VALUES (?, ?, ?)',
-                       ("current", 1, "started"))
-        db_conn.execute('INSERT INTO sessions (session_id, project_id, status) VALUES (?, ?, ?)',
-                       ("stale", 1, "started"))
-        db_conn.commit()
+        project_id = upsert_project(tx, "/test")
+        get_cursor(tx).executemany(_INSERT_SESSION, [("current", project_id, "started"), ("stale", project_id, "started")])
 
-        clean_sessions(db_conn, 1, "current")
-        db_conn.commit()
+        clean_sessions(tx, project_id, "current")
 
         # Check stale was removed
-        assert db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("stale",)).fetchone() is None
-        assert db_conn.execute('SELECT * FROM sessions WHERE session_id = ?', ("current",)).fetchone() is not None
+        assert query(tx, _SESSION_BY_ID, ("stale",)) == []
+        assert query(tx, _SESSION_BY_ID, ("current",)) != []
 
 
 class TestProjectPathStability:
@@ -227,7 +247,7 @@ class TestProjectPathStability:
     the session's project_path should remain stable at the original path.
     """
 
-    def test_cwd_change_does_not_create_new_project_for_session(self, db_conn, temp_dir):
+    def test_cwd_change_does_not_create_new_project_for_session(self, tx):
         """Test that changing cwd doesn't change the session's project.
 
         Scenario:
@@ -238,40 +258,40 @@ class TestProjectPathStability:
         - Session's project_id stays the same (original project)
         - No new project association for this session
         """
-        from db import upsert_project, upsert_session, get_session_project_path
-
         original_path = "/Users/apo/code/workio"
         subdir_path = "/Users/apo/code/workio/app"
 
-        # Create two projects with different paths
-        original_project_id = upsert_project(db_conn, original_path)
-        subdir_project_id = upsert_project(db_conn, subdir_path)
-        db_conn.commit()
+        # Create two projects with different paths in one statement
+        rows = psycopg2.extras.execute_values(
+            get_cursor(tx),
+            "INSERT INTO projects (path) VALUES %s RETURNING id, path",
+            [(original_path,), (subdir_path,)],
+            fetch=True,
+        )
+        project_ids = {row['path']: row['id'] for row in rows}
+        original_project_id = project_ids[original_path]
+        subdir_project_id = project_ids[subdir_path]
 
         # Verify they are different projects
         assert original_project_id != subdir_project_id
 
         # First hook: session created with original path
-        upsert_session(db_conn, "test-session", original_project_id, "started", "/transcript.jsonl")
-        db_conn.commit()
+        upsert_session(tx, "test-session", original_project_id, "started", "/transcript.jsonl")
 
         # Verify session has original project_id
-        session = db_conn.execute('SELECT project_id FROM sessions WHERE session_id = ?',
-                                 ("test-session",)).fetchone()
+        session = query(tx, _SESSION_BY_ID, ("test-session",))[0]
         assert session['project_id'] == original_project_id
 
         # Second hook: same session but with subdirectory project_id (simulating cwd change)
-        upsert_session(db_conn, "test-session", subdir_project_id, "active", "/transcript.jsonl")
-        db_conn.commit()
+        upsert_session(tx, "test-session", subdir_project_id, "active", "/transcript.jsonl")
 
         # Verify project_id was NOT updated - should still be original
-        session = db_conn.execute('SELECT project_id FROM sessions WHERE session_id = ?',
-                                 ("test-session",)).fetchone()
+        session = query(tx, _SESSION_BY_ID, ("test-session",))[0]
         assert session['project_id'] == original_project_id, \
             f"Session project_id should remain {original_project_id}, but got {session['project_id']}"
 
         # Verify get_session_project_path returns the original path
-        stored_path = get_session_project_path(db_conn, "test-session")
+        stored_path = get_session_project_path(tx, "test-session")
         assert stored_path == original_path, \
             f"Stored project path should be '{original_path}', but got '{stored_path}'"
 
@@ -281,15 +301,12 @@ class TestProjectPathStability:
         When Claude changes cwd, the session index file is still at the original
         project path. We should use the stored path, not the current cwd.
         """
-        from db import upsert_project, upsert_session, get_session_project_path
-        from monitor import get_session_index_entry
-
         original_path = "/test/original/project"
         subdir_path = "/test/original/project/subdir"
 
         # Create a mock sessions-index.json at the original path location
         claude_dir = temp_dir / ".claude" / "projects" / original_path.replace('/', '-')
-        claude_dir.mkdir(parents=True)
+        claude_dir.mkdir(parents=True, exist_ok=True)
         index_file = claude_dir / "sessions-index.json"
         index_file.write_text(json.dumps({
             "entries": [
@@ -313,9 +330,9 @@ class TestProjectPathStability:
             assert entry_subdir is None, "Index should not be found at subdir path"
 
         # Setup session with original path
-        project_id = upsert_project(db_conn, original_path)
-        upsert_session(db_conn, "test-session", project_id, "started", "")
-        db_conn.commit()
+        with db_conn:
+            project_id = upsert_project(db_conn, original_path)
+            upsert_session(db_conn, "test-session", project_id, "started", "")
 
         # Verify stored path is the original
         stored_path = get_session_project_path(db_conn, "test-session")
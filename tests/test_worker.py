@@ -2,17 +2,329 @@
 Tests for worker.py - debouncing, locking, and transcript processing.
 """
 
+import difflib
+import fcntl
 import json
-import sys
+import os
 import threading
 import time
-from datetime import datetime, timedelta
-from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 
-sys.path.insert(0, str(Path(__file__).parent.parent))
+from db import create_prompt, create_message, get_cursor, get_latest_prompt, upsert_project, upsert_session
+from worker import (
+    acquire_lock, generate_diff, iter_file_lines, process_session, process_transcript, release_lock,
+    shift_hunk_header
+)
+
+
+def write_marker(marker_file, start_ns: int, latest_ns: int) -> None:
+    """Write a debounce marker the way the daemon does: to a temp file, then os.replace."""
+    tmp_file = marker_file.with_name(marker_file.name + ".tmp")
+    tmp_file.write_text(json.dumps({"start_ns": start_ns, "latest_ns": latest_ns}))
+    os.replace(tmp_file, marker_file)
+
+
+def create_session(conn, transcript_path, prompt_text: str | None = None) -> int:
+    """Create the test project, session and prompt the worker reads; return the prompt id."""
+    project_id = upsert_project(conn, "/test")
+    upsert_session(conn, "test-session", project_id, "active", str(transcript_path))
+    prompt_id = create_prompt(conn, "test-session", prompt_text)
+    conn.commit()
+    return prompt_id
+
+
+def fetch_all(conn, sql: str, params: tuple = ()) -> list[dict]:
+    """Run a query and return its rows as dicts."""
+    cur = get_cursor(conn)
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+def untrimmed_diff(old: str, new: str) -> tuple[str, int, int]:
+    """Diff the whole strings the way generate_diff did before windowing."""
+    diff = list(difflib.unified_diff(
+        old.splitlines(keepends=True), new.splitlines(keepends=True),
+        fromfile="a/file.py", tofile="b/file.py", lineterm="", n=3
+    ))
+    body = diff[2:]
+    return (
+        "".join(diff),
+        sum(line.startswith('+') for line in body),
+        sum(line.startswith('-') for line in body),
+    )
+
+
+def numbered_lines(count: int) -> list[str]:
+    """Return count distinct newline-terminated lines."""
+    return [f"line {i}\n" for i in range(1, count + 1)]
+
+
+def user_line(uuid: str, text: str) -> str:
+    """Return a transcript line for a plain user message."""
+    return json.dumps({
+        "type": "user",
+        "uuid": uuid,
+        "timestamp": "2024-01-01T10:00:00",
+        "message": {"role": "user", "content": text}
+    })
+
+
+def tool_use_line(uuid: str, tool_use_id: str) -> str:
+    """Return a transcript line for an assistant Bash tool call."""
+    return json.dumps({
+        "type": "assistant",
+        "uuid": uuid,
+        "timestamp": "2024-01-01T10:00:00",
+        "message": {
+            "role": "assistant",
+            "type": "message",
+            "content": [{"type": "tool_use", "id": tool_use_id, "name": "Bash", "input": {"command": "ls"}}]
+        }
+    })
+
+
+class TestIterFileLines:
+    """Tests for splitting a transcript into lines with resume offsets."""
+
+    def test_yields_lines_with_next_offsets(self, tmp_path):
+        path = tmp_path / "t.jsonl"
+        path.write_bytes(b'a\nbb\n')
+
+        assert list(iter_file_lines(path)) == [(b'a', 2), (b'bb', 5)]
+
+    def test_starts_at_offset(self, tmp_path):
+        path = tmp_path / "t.jsonl"
+        path.write_bytes(b'a\nbb\nccc\n')
+
+        assert list(iter_file_lines(path, 2)) == [(b'bb', 5), (b'ccc', 9)]
+        assert list(iter_file_lines(path, 9)) == []
+
+    def test_partial_last_line_does_not_advance(self, tmp_path):
+        """Test that a line without a newline resumes from its own start."""
+        path = tmp_path / "t.jsonl"
+        path.write_bytes(b'a\nbb')
+
+        assert list(iter_file_lines(path)) == [(b'a', 2), (b'bb', 2)]
+
+    def test_empty_file(self, tmp_path):
+        path = tmp_path / "t.jsonl"
+        path.write_bytes(b'')
+
+        assert list(iter_file_lines(path)) == []
+
+
+class TestTranscriptReadState:
+    """Tests for resuming transcript parsing from the saved read offset (no database)."""
+
+    @pytest.fixture
+    def transcript(self, tmp_path):
+        path = tmp_path / "transcript.jsonl"
+        path.write_text(user_line("user-msg-1", "First") + '\n' + user_line("user-msg-2", "Second") + '\n')
+        return path
+
+    def run(self, transcript, read_state) -> list[str]:
+        """Process transcript with the DB calls patched; return the UUIDs that were read."""
+        with patch('worker.get_latest_prompt', return_value={'id': 1, 'prompt': "Test prompt"}), \
+             patch('worker.get_existing_message_uuids', return_value=set()) as mock_existing, \
+             patch('worker.create_messages', side_effect=lambda conn, rows: {row[1]: i for i, row in enumerate(rows, 1)}):
+            process_transcript(MagicMock(), "test-session", str(transcript), read_state)
+        return list(mock_existing.call_args[0][1])
+
+    def test_resumes_after_stored_lines(self, transcript):
+        read_state = {}
+        assert self.run(transcript, read_state) == ["user-msg-1", "user-msg-2"]
+        assert read_state == {'path': str(transcript), 'ino': transcript.stat().st_ino, 'offset': transcript.stat().st_size}
+
+        with open(transcript, 'a') as f:
+            f.write(user_line("user-msg-3", "Third") + '\n')
+
+        assert self.run(transcript, read_state) == ["user-msg-3"]
+        assert read_state['offset'] == transcript.stat().st_size
+
+    def test_partial_line_is_read_again(self, transcript):
+        read_state = {}
+        self.run(transcript, read_state)
+        offset = read_state['offset']
+        line = user_line("user-msg-3", "Third")
+
+        with open(transcript, 'a') as f:
+            f.write(line[:20])
+        assert self.run(transcript, read_state) == []
+        assert read_state['offset'] == offset
+
+        with open(transcript, 'a') as f:
+            f.write(line[20:] + '\n')
+        assert self.run(transcript, read_state) == ["user-msg-3"]
+
+    def test_other_path_reads_whole_file(self, transcript):
+        read_state = {'path': "/other/transcript.jsonl", 'ino': transcript.stat().st_ino, 'offset': 10}
+
+        assert self.run(transcript, read_state) == ["user-msg-1", "user-msg-2"]
+
+    def test_replaced_file_reads_whole_file(self, transcript):
+        read_state = {}
+        self.run(transcript, read_state)
+        replacement = transcript.with_name("new.jsonl")
+        replacement.write_text(transcript.read_text() + user_line("user-msg-3", "Third") + '\n')
+        os.replace(replacement, transcript)
+
+        assert self.run(transcript, read_state) == ["user-msg-1", "user-msg-2", "user-msg-3"]
+
+    def test_truncated_file_reads_whole_file(self, transcript):
+        read_state = {}
+        self.run(transcript, read_state)
+        transcript.write_text(user_line("user-msg-9", "Rewritten") + '\n')
+
+        assert self.run(transcript, read_state) == ["user-msg-9"]
+
+    def test_failed_tool_call_is_retried(self, transcript):
+        """Test that the offset stops at a line whose tool call failed to process."""
+        read_state = {}
+        self.run(transcript, read_state)
+        tool_offset = read_state['offset']
+        with open(transcript, 'a') as f:
+            f.write(tool_use_line("assistant-msg-1", "toolu_1") + '\n')
+            f.write(user_line("user-msg-3", "Third") + '\n')
+
+        with patch('worker.build_tool_json', side_effect=ValueError("boom")):
+            assert self.run(transcript, read_state) == ["toolu_1", "user-msg-3"]
+        assert read_state['offset'] == tool_offset
+
+        assert self.run(transcript, read_state) == ["toolu_1", "user-msg-3"]
+        assert read_state['offset'] == transcript.stat().st_size
+
+
+    @pytest.mark.parametrize("status,kept", [("active", True), ("ended", False)])
+    def test_offset_file_removed_when_session_ended(self, debounce_dir, transcript, status, kept):
+        timestamp = time.time_ns()
+        write_marker(debounce_dir / "test-session.marker", timestamp, timestamp)
+        offset_file = debounce_dir / "test-session.offset"
+        offset_file.write_text(json.dumps({'path': str(transcript), 'ino': transcript.stat().st_ino, 'offset': 0}))
+
+        with patch('worker.DEBOUNCE_DIR', debounce_dir), \
+             patch('worker.DEBOUNCE_SECONDS', 0), \
+             patch('worker.get_db', return_value=MagicMock()), \
+             patch('worker.log_many'), \
+             patch('worker.notify'), \
+             patch('worker.get_session', return_value={'status': status, 'transcript_path': str(transcript)}), \
+             patch('worker.get_latest_prompt', return_value={'id': 1, 'prompt': "Test prompt"}), \
+             patch('worker.get_existing_message_uuids', return_value=set()), \
+             patch('worker.create_messages', return_value={}):
+            process_session("test-session", timestamp)
+
+        assert offset_file.exists() == kept
+        if kept:
+            assert json.loads(offset_file.read_text())['offset'] == transcript.stat().st_size
+
+
+class TestWorkerLock:
+    """Tests for the per-session worker lock (no database)."""
+
+    def test_acquire_free_lock(self, tmp_path):
+        lock_file = tmp_path / "s.lock"
+
+        fd = acquire_lock(lock_file)
+
+        assert os.fstat(fd).st_ino == lock_file.stat().st_ino
+        release_lock(lock_file, fd)
+        assert not lock_file.exists()
+
+    def test_busy_lock_waits_for_release(self, tmp_path):
+        """Test that a second worker blocks until the holder releases the lock."""
+        lock_file = tmp_path / "s.lock"
+        holder_fd = acquire_lock(lock_file)
+        waited = threading.Event()
+        acquired = threading.Event()
+
+        def waiter():
+            fd = acquire_lock(lock_file, on_wait=waited.set)
+            acquired.set()
+            release_lock(lock_file, fd)
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        try:
+            assert waited.wait(timeout=5)
+            assert not acquired.is_set()
+        finally:
+            release_lock(lock_file, holder_fd)
+        t.join(timeout=5)
+
+        assert acquired.is_set()
+        assert not lock_file.exists()
+
+    def test_retries_on_unlinked_lock_file(self, tmp_path):
+        """Test that a lock won on a file the holder already unlinked is not kept."""
+        lock_file = tmp_path / "s.lock"
+        holder_fd = acquire_lock(lock_file)
+        waited = threading.Event()
+        result = []
+
+        t = threading.Thread(target=lambda: result.append(acquire_lock(lock_file, on_wait=waited.set)))
+        t.start()
+        assert waited.wait(timeout=5)
+        # release_lock unlinks before unlocking, so the waiter wakes on the orphaned inode
+        release_lock(lock_file, holder_fd)
+        t.join(timeout=5)
+
+        fd = result[0]
+        try:
+            assert os.fstat(fd).st_ino == lock_file.stat().st_ino
+        finally:
+            release_lock(lock_file, fd)
+
+
+class TestGenerateDiff:
+    """Tests for diffing Edit tool strings."""
+
+    def test_identical_input(self):
+        """Test that identical or empty strings produce no diff."""
+        assert generate_diff("a\nb\n", "a\nb\n", "/src/file.py") == ("", 0, 0)
+        assert generate_diff("", "", "/src/file.py") == ("", 0, 0)
+
+    @pytest.mark.parametrize("old_lines,new_lines", [
+        (numbered_lines(20), ["changed\n"] + numbered_lines(20)[1:]),
+        (numbered_lines(20), numbered_lines(20)[:-1] + ["changed\n"]),
+        (numbered_lines(20), numbered_lines(20) + ["appended\n"]),
+        (numbered_lines(100), numbered_lines(49) + ["changed\n", "inserted\n"] + numbered_lines(100)[50:]),
+        (numbered_lines(100), numbered_lines(10) + numbered_lines(100)[12:40] + ["x\n"] + numbered_lines(100)[40:]),
+        (["only\n"], ["replaced\n"]),
+        (numbered_lines(5), []),
+    ], ids=["start", "end", "append", "middle", "two-hunks", "single-line", "delete-all"])
+    def test_matches_untrimmed_diff(self, old_lines, new_lines):
+        """Test that the windowed diff equals a diff of the whole strings."""
+        old, new = "".join(old_lines), "".join(new_lines)
+
+        assert generate_diff(old, new, "/src/file.py") == untrimmed_diff(old, new)
+
+    def test_middle_hunk_header_uses_file_line_numbers(self):
+        """Test that a hunk deep in the file reports its real line numbers."""
+        old_lines = numbered_lines(100)
+        new_lines = old_lines[:49] + ["changed\n"] + old_lines[50:]
+
+        diff_text, lines_added, lines_removed = generate_diff("".join(old_lines), "".join(new_lines), "/src/file.py")
+
+        assert "@@ -47,7 +47,7 @@" in diff_text
+        assert (lines_added, lines_removed) == (1, 1)
+
+    def test_single_line_hunk_omits_count(self):
+        """Test that one-line hunks keep the count-less header form."""
+        diff_text, lines_added, lines_removed = generate_diff("a\n", "b\n", "/src/file.py")
+
+        assert diff_text == "--- a/file.py+++ b/file.py@@ -1 +1 @@-a\n+b\n"
+        assert (lines_added, lines_removed) == (1, 1)
+
+    @pytest.mark.parametrize("header,offset,expected", [
+        ("@@ -1,7 +1,8 @@", 10, "@@ -11,7 +11,8 @@"),
+        ("@@ -3 +3 @@", 4, "@@ -7 +7 @@"),
+        ("@@ -2,3 +2 @@", 5, "@@ -7,3 +7 @@"),
+        ("@@ -1,7 +1,8 @@ def foo():", 2, "@@ -3,7 +3,8 @@ def foo():"),
+    ])
+    def test_shift_hunk_header(self, header, offset, expected):
+        """Test that only the start lines move and omitted counts stay omitted."""
+        assert shift_hunk_header(header, offset) == expected
 
 
 class TestProcessTranscript:
@@ -20,40 +332,35 @@ class TestProcessTranscript:
 
     def test_process_transcript_creates_messages(self, db_conn, sample_transcript):
         """Test that transcript processing creates messages."""
-        from worker import process_transcript
-        from db import create_prompt
-
         # Setup
-        prompt_id = create_prompt(db_conn, "test-session", "Test prompt")
-        db_conn.commit()
+        prompt_id = create_session(db_conn, sample_transcript, "Test prompt")
 
         process_transcript(db_conn, "test-session", str(sample_transcript))
         db_conn.commit()
 
         # Check messages were created
-        messages = db_conn.execute('SELECT * FROM messages WHERE prompt_id = ?', (prompt_id,)).fetchall()
+        messages = {
+            row['uuid']: row
+            for row in fetch_all(db_conn, 'SELECT * FROM messages WHERE prompt_id = %s', (prompt_id,))
+        }
         assert len(messages) == 3
 
         # Check user message
-        user_msg = db_conn.execute('SELECT * FROM messages WHERE uuid = ?', ("user-msg-1",)).fetchone()
-        assert user_msg['is_user'] == 1
+        user_msg = messages["user-msg-1"]
+        assert user_msg['is_user'] is True
         assert user_msg['body'] == "Hello, how are you?"
 
         # Check assistant text message
-        assistant_msg = db_conn.execute('SELECT * FROM messages WHERE uuid = ?', ("assistant-msg-1",)).fetchone()
-        assert assistant_msg['is_user'] == 0
-        assert assistant_msg['thinking'] == 0
+        assistant_msg = messages["assistant-msg-1"]
+        assert assistant_msg['is_user'] is False
+        assert assistant_msg['thinking'] is False
 
         # Check thinking message
-        thinking_msg = db_conn.execute('SELECT * FROM messages WHERE uuid = ?', ("assistant-msg-2",)).fetchone()
-        assert thinking_msg['thinking'] == 1
+        assert messages["assistant-msg-2"]['thinking'] is True
 
     def test_process_transcript_skips_existing(self, db_conn, sample_transcript):
         """Test that existing messages are not duplicated."""
-        from worker import process_transcript
-        from db import create_prompt, create_message
-
-        prompt_id = create_prompt(db_conn, "test-session")
+        prompt_id = create_session(db_conn, sample_transcript)
         # Pre-create one message
         create_message(db_conn, prompt_id, "user-msg-1", "2024-01-01", "Existing", False, True)
         db_conn.commit()
@@ -62,40 +369,34 @@ class TestProcessTranscript:
         db_conn.commit()
 
         # Should only have 3 messages (1 existing + 2 new)
-        count = db_conn.execute('SELECT COUNT(*) FROM messages WHERE prompt_id = ?', (prompt_id,)).fetchone()[0]
-        assert count == 3
+        rows = fetch_all(db_conn, 'SELECT uuid, body FROM messages WHERE prompt_id = %s ORDER BY id', (prompt_id,))
+        assert [(row['uuid'], row['body']) for row in rows][0] == ("user-msg-1", "Existing")
+        assert len(rows) == 3
 
     def test_process_transcript_no_prompt(self, db_conn, sample_transcript):
         """Test handling when no prompt exists."""
-        from worker import process_transcript
+        # Session without a prompt - should log and return
+        project_id = upsert_project(db_conn, "/test")
+        upsert_session(db_conn, "test-session", project_id, "active", str(sample_transcript))
+        db_conn.commit()
 
-        # No prompt created - should log and return
         process_transcript(db_conn, "test-session", str(sample_transcript))
         db_conn.commit()
 
         # Check no messages created
-        count = db_conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
-        assert count == 0
+        assert fetch_all(db_conn, 'SELECT id FROM messages') == []
 
     def test_process_transcript_missing_file(self, db_conn):
         """Test handling of missing transcript file."""
-        from worker import process_transcript
-        from db import create_prompt
-
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, "/nonexistent/file.jsonl")
 
         # Should not raise, just log
         process_transcript(db_conn, "test-session", "/nonexistent/file.jsonl")
 
     def test_process_transcript_sets_prompt_from_user_message(self, db_conn, sample_transcript):
         """Test that prompt text is set from user message if empty."""
-        from worker import process_transcript
-        from db import create_prompt, get_latest_prompt
-
         # Create prompt without text
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
         process_transcript(db_conn, "test-session", str(sample_transcript))
         db_conn.commit()
@@ -108,269 +409,192 @@ class TestProcessTranscript:
 class TestDebounce:
     """Tests for debounce logic."""
 
-    def test_debounce_skips_non_latest(self, db_conn, debounce_dir, temp_dir):
+    def test_debounce_skips_non_latest(self, db_conn, debounce_dir):
         """Test that non-latest timestamps skip processing."""
-        from worker import process_session
-
-        db_path = temp_dir / "test.db"
-
         # Create marker with FUTURE start timestamp so debounce hasn't expired
-        future_time = (datetime.now() + timedelta(hours=1)).isoformat()
+        future_time = time.time_ns() + 3600 * 10**9
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": future_time,
-            "latest": "different-timestamp"
-        }))
+        write_marker(marker_file, future_time, 1)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0), \
-             patch('worker.time.sleep'):  # Skip the initial sleep
-            process_session("test-session", "my-timestamp")
+             patch('worker.time.sleep') as mock_sleep:
+            process_session("test-session", 2)
 
-        # Check that processing was skipped (marker still exists)
+        # Check that processing was skipped (marker still exists) before the debounce sleep
         assert marker_file.exists()
+        mock_sleep.assert_not_called()
 
-    def test_debounce_processes_latest(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_debounce_processes_latest(self, db_conn, debounce_dir, sample_transcript):
         """Test that latest timestamp processes the job."""
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0):
-            from worker import process_session
             process_session("test-session", timestamp)
 
         # Check marker was cleaned up
         assert not marker_file.exists()
 
         # Check messages were processed
-        count = db_conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
-        assert count > 0
+        assert fetch_all(db_conn, 'SELECT id FROM messages') != []
 
 
 class TestLocking:
     """Tests for lock mechanism."""
 
-    def test_lock_acquired_and_released(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_lock_acquired_and_released(self, db_conn, debounce_dir, sample_transcript):
         """Test that lock is acquired and released."""
-        from worker import process_session
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
         lock_file = debounce_dir / "test-session.lock"
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0):
             process_session("test-session", timestamp)
 
         # Lock should be released
         assert not lock_file.exists()
 
-    def test_lock_waits_for_existing(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_lock_waits_for_existing(self, db_conn, debounce_dir, sample_transcript):
         """Test that worker logs waiting for lock when lock exists."""
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
         lock_file = debounce_dir / "test-session.lock"
 
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
-        # Create a lock file
-        lock_file.write_text(datetime.now().isoformat())
+        # Hold the lock from another open file description, as a running worker would
+        holder_fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(holder_fd, fcntl.LOCK_EX)
 
-        # Track lock wait loops
+        # Track blocking lock attempts; release the holder's lock on the first one
         lock_wait_count = [0]
+        real_flock = fcntl.flock
 
-        def mock_sleep(seconds):
-            if seconds == 1:  # Lock wait interval (hardcoded in worker)
+        def mock_flock(fd, operation):
+            if operation == fcntl.LOCK_EX:
                 lock_wait_count[0] += 1
-                # Remove lock after first wait
-                if lock_wait_count[0] >= 1 and lock_file.exists():
-                    lock_file.unlink()
-            # Don't actually sleep
+                real_flock(holder_fd, fcntl.LOCK_UN)
+            return real_flock(fd, operation)
 
-        with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
-             patch('worker.DEBOUNCE_SECONDS', 2), \
-             patch('worker.time.sleep', side_effect=mock_sleep):
-            from worker import process_session
-            process_session("test-session", timestamp)
+        try:
+            with patch('worker.DEBOUNCE_DIR', debounce_dir), \
+                 patch('worker.DEBOUNCE_SECONDS', 2), \
+                 patch('worker.time.sleep'), \
+                 patch('worker.fcntl.flock', side_effect=mock_flock):
+                process_session("test-session", timestamp)
+        finally:
+            os.close(holder_fd)
 
-        # Should have waited for lock at least once
-        assert lock_wait_count[0] >= 1, f"Expected lock wait, got count: {lock_wait_count[0]}"
+        # Should have blocked on the lock exactly once
+        assert lock_wait_count[0] == 1, f"Expected one lock wait, got count: {lock_wait_count[0]}"
 
         # Check "Waiting for lock" was logged
-        logs = db_conn.execute('SELECT data FROM logs').fetchall()
-        log_messages = [json.loads(row['data']).get('message') for row in logs]
+        log_messages = [row['data'].get('message') for row in fetch_all(db_conn, 'SELECT data FROM logs')]
         assert "Waiting for lock" in log_messages
 
-    def test_stale_lock_removed(self, db_conn, debounce_dir, sample_transcript, temp_dir):
-        """Test that stale locks are removed."""
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
+    def test_leftover_lock_file_does_not_block(self, db_conn, debounce_dir, sample_transcript):
+        """Test that a lock file left by a dead worker does not block processing."""
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
         lock_file = debounce_dir / "test-session.lock"
 
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
-        # Create a stale lock (very old)
-        old_time = (datetime.now() - timedelta(hours=1)).isoformat()
-        lock_file.write_text(old_time)
+        # A lock file nobody holds - the kernel released its flock when the owner exited
+        lock_file.write_text("")
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
-             patch('worker.DEBOUNCE_SECONDS', 1):  # Lock timeout = 30 seconds
-            from worker import process_session
+             patch('worker.DEBOUNCE_SECONDS', 0):
             process_session("test-session", timestamp)
 
-        # Should have processed (stale lock removed)
+        # Should have processed without waiting
         assert not lock_file.exists()
         assert not marker_file.exists()
 
-    def test_concurrent_workers_serialize(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_concurrent_workers_serialize(self, db_conn, debounce_dir, sample_transcript):
         """Test that concurrent workers are serialized by lock."""
-        from db import create_prompt, upsert_session
+        # Setup - each worker opens its own connection
+        create_session(db_conn, sample_transcript)
 
-        db_path = temp_dir / "test.db"
-
-        # Setup - use a fresh connection for each worker
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
-
-        timestamp1 = datetime.now().isoformat()
-        timestamp2 = (datetime.now() + timedelta(milliseconds=100)).isoformat()
+        # Two workers spawned for the same event (e.g. by the daemon and a backfill)
+        timestamp = time.time_ns()
 
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": timestamp1,
-            "latest": timestamp2
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
         results = []
+        lock_acquired = threading.Event()
+        real_acquire_lock = acquire_lock
+
+        def signalling_acquire_lock(*args, **kwargs):
+            fd = real_acquire_lock(*args, **kwargs)
+            lock_acquired.set()
+            return fd
 
         def run_worker(ts):
-            with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-                 patch('db.DB_PATH', db_path), \
-                 patch('worker.DEBOUNCE_SECONDS', 0):
-                from worker import process_session
-                try:
-                    process_session("test-session", ts)
-                    results.append(("success", ts))
-                except Exception as e:
-                    results.append(("error", str(e)))
-
-        # Start two workers
-        t1 = threading.Thread(target=run_worker, args=(timestamp1,))
-        t2 = threading.Thread(target=run_worker, args=(timestamp2,))
-
-        t1.start()
-        time.sleep(0.1)  # Give first worker time to acquire lock
-        t2.start()
-
-        t1.join()
-        t2.join()
+            try:
+                process_session("test-session", ts)
+                results.append(("success", ts))
+            except Exception as e:
+                results.append(("error", str(e)))
+
+        # Start two workers; the second starts once the first holds the lock
+        t1 = threading.Thread(target=run_worker, args=(timestamp,))
+        t2 = threading.Thread(target=run_worker, args=(timestamp,))
+
+        with patch('worker.DEBOUNCE_DIR', debounce_dir), \
+             patch('worker.DEBOUNCE_SECONDS', 0), \
+             patch('worker.acquire_lock', side_effect=signalling_acquire_lock):
+            t1.start()
+            assert lock_acquired.wait(timeout=5), "First worker never acquired the lock"
+            t2.start()
+
+            t1.join()
+            t2.join()
 
         # Both should complete (one processes, one skips due to marker gone)
         assert len(results) == 2
 
-    def test_marker_preserved_when_new_event_during_processing(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_marker_preserved_when_new_event_during_processing(self, db_conn, debounce_dir, sample_transcript):
         """Test that marker is NOT deleted if a new event arrived during processing."""
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        original_timestamp = datetime.now().isoformat()
+        original_timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": original_timestamp,
-            "latest": original_timestamp
-        }))
+        write_marker(marker_file, original_timestamp, original_timestamp)
 
         # We'll update the marker during processing to simulate a new event
-        new_event_timestamp = (datetime.now() + timedelta(seconds=1)).isoformat()
+        new_event_timestamp = time.time_ns() + 10**9
         processing_started = [False]
 
         # Patch process_transcript to update marker mid-processing
-        original_process_transcript = None
-
-        def mock_process_transcript(conn, session_id, transcript_path):
+        def mock_process_transcript(conn, session_id, transcript_path, read_state=None):
             processing_started[0] = True
             # Simulate new event arriving during processing
-            marker_file.write_text(json.dumps({
-                "start": original_timestamp,
-                "latest": new_event_timestamp
-            }))
+            write_marker(marker_file, original_timestamp, new_event_timestamp)
             # Call original
-            original_process_transcript(conn, session_id, transcript_path)
+            return process_transcript(conn, session_id, transcript_path, read_state)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0):
-            from worker import process_session, process_transcript
-            original_process_transcript = process_transcript
-
             with patch('worker.process_transcript', side_effect=mock_process_transcript):
                 process_session("test-session", original_timestamp)
 
@@ -379,31 +603,19 @@ class TestLocking:
 
         # Verify the marker has the new event's timestamp
         marker_data = json.loads(marker_file.read_text())
-        assert marker_data['latest'] == new_event_timestamp
+        assert marker_data['latest_ns'] == new_event_timestamp
 
-    def test_marker_deleted_when_no_new_events(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_marker_deleted_when_no_new_events(self, db_conn, debounce_dir, sample_transcript):
         """Test that marker IS deleted when no new events arrived during processing."""
-        from db import create_prompt, upsert_session
-
-        db_path = temp_dir / "test.db"
-
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0):
-            from worker import process_session
             process_session("test-session", timestamp)
 
         # Marker should be deleted - no new events
@@ -413,7 +625,7 @@ class TestLocking:
 class TestEndToEndDebounce:
     """End-to-end tests for the complete debounce flow."""
 
-    def test_rapid_events_then_last_event_processes(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_rapid_events_then_last_event_processes(self, db_conn, debounce_dir, sample_transcript):
         """
         Test the complete flow:
         1. Multiple rapid events come in
@@ -424,49 +636,34 @@ class TestEndToEndDebounce:
 
         This ensures no events are lost even with the race condition.
         """
-        from db import create_prompt, upsert_session
-        from worker import process_transcript as real_process_transcript
-
-        db_path = temp_dir / "test.db"
 
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
         # Simulate rapid events
-        event1_ts = datetime.now().isoformat()
-        event4_ts = (datetime.now() + timedelta(seconds=1)).isoformat()
+        event1_ts = time.time_ns()
+        event4_ts = time.time_ns() + 10**9
 
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": event1_ts,
-            "latest": event1_ts
-        }))
+        write_marker(marker_file, event1_ts, event1_ts)
 
         results = []
         processing_count = [0]
 
-        def mock_process_transcript(conn, session_id, transcript_path):
+        def mock_process_transcript(conn, session_id, transcript_path, read_state=None):
             processing_count[0] += 1
 
             # On first processing, simulate event 4 arriving mid-processing
             if processing_count[0] == 1:
-                marker_file.write_text(json.dumps({
-                    "start": event1_ts,
-                    "latest": event4_ts
-                }))
+                write_marker(marker_file, event1_ts, event4_ts)
 
             # Call real function
-            real_process_transcript(conn, session_id, transcript_path)
+            return process_transcript(conn, session_id, transcript_path, read_state)
 
         # Run both workers with the mock active throughout
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0), \
              patch('worker.process_transcript', side_effect=mock_process_transcript):
-            from worker import process_session
 
             # Worker 1 processes, event4 arrives mid-processing
             process_session("test-session", event1_ts)
@@ -475,7 +672,7 @@ class TestEndToEndDebounce:
             # After worker1: marker should still exist with event4_ts
             assert marker_file.exists(), "Marker should exist after worker1 (event4 arrived during processing)"
             marker_data = json.loads(marker_file.read_text())
-            assert marker_data['latest'] == event4_ts, "Marker should have event4's timestamp"
+            assert marker_data['latest_ns'] == event4_ts, "Marker should have event4's timestamp"
 
             # Worker 4 processes (the one spawned by event4)
             process_session("test-session", event4_ts)
@@ -490,50 +687,35 @@ class TestEndToEndDebounce:
         # Verify both workers completed
         assert len(results) == 2
 
-    def test_last_event_always_processes(self, db_conn, debounce_dir, sample_transcript, temp_dir):
+    def test_last_event_always_processes(self, db_conn, debounce_dir, sample_transcript):
         """
         Test that the absolute last event always gets processed,
         even if it arrives during another worker's processing.
         """
-        from db import create_prompt, upsert_session
-        from worker import process_transcript as real_process_transcript
-
-        db_path = temp_dir / "test.db"
 
         # Setup
-        db_conn.execute('INSERT INTO projects (id, path) VALUES (1, "/test")')
-        upsert_session(db_conn, "test-session", 1, "active", str(sample_transcript))
-        create_prompt(db_conn, "test-session")
-        db_conn.commit()
+        create_session(db_conn, sample_transcript)
 
-        first_ts = datetime.now().isoformat()
-        last_ts = (datetime.now() + timedelta(seconds=1)).isoformat()
+        first_ts = time.time_ns()
+        last_ts = time.time_ns() + 10**9
 
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": first_ts,
-            "latest": first_ts
-        }))
+        write_marker(marker_file, first_ts, first_ts)
 
         processing_times = []
 
-        def mock_process_transcript(conn, session_id, transcript_path):
-            processing_times.append(datetime.now().isoformat())
+        def mock_process_transcript(conn, session_id, transcript_path, read_state=None):
+            processing_times.append(time.time_ns())
 
             # On first call, simulate the "last event" arriving
             if len(processing_times) == 1:
-                marker_file.write_text(json.dumps({
-                    "start": first_ts,
-                    "latest": last_ts
-                }))
+                write_marker(marker_file, first_ts, last_ts)
 
-            real_process_transcript(conn, session_id, transcript_path)
+            return process_transcript(conn, session_id, transcript_path, read_state)
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0), \
              patch('worker.process_transcript', side_effect=mock_process_transcript):
-            from worker import process_session
 
             # First worker processes
             process_session("test-session", first_ts)
@@ -554,32 +736,25 @@ class TestEndToEndDebounce:
 class TestErrorHandling:
     """Tests for error handling in worker."""
 
-    def test_error_logged_and_raised(self, db_conn, debounce_dir, temp_dir):
+    def test_error_logged_and_raised(self, db_conn, debounce_dir):
         """Test that errors are logged and re-raised."""
-        db_path = temp_dir / "test.db"
-
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time_ns()
         marker_file = debounce_dir / "test-session.marker"
-        marker_file.write_text(json.dumps({
-            "start": timestamp,
-            "latest": timestamp
-        }))
+        write_marker(marker_file, timestamp, timestamp)
 
         def raise_error(*args):
             raise ValueError("Test error")
 
         with patch('worker.DEBOUNCE_DIR', debounce_dir), \
-             patch('db.DB_PATH', db_path), \
              patch('worker.DEBOUNCE_SECONDS', 0), \
              patch('worker.get_session', side_effect=raise_error):
 
             with pytest.raises(RuntimeError, match="Worker failed"):
-                from worker import process_session
                 process_session("test-session", timestamp)
 
         # Check error was logged
-        log_entry = db_conn.execute('SELECT data FROM logs ORDER BY id DESC LIMIT 1').fetchone()
-        assert log_entry is not None
-        data = json.loads(log_entry['data'])
+        log_entries = fetch_all(db_conn, 'SELECT data FROM logs ORDER BY id DESC LIMIT 1')
+        assert log_entries
+        data = log_entries[0]['data']
         assert data.get('message') == "Worker error"
         assert "Test error" in data.get('error', '')
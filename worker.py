@@ -4,17 +4,20 @@ Debounced async worker for processing session jobs.
 """
 
 import difflib
+import fcntl
 import json
+import mmap
 import os
+import re
 import sys
 import time
-from datetime import datetime
+from collections.abc import Iterator
 from pathlib import Path
 
 from db import (
-    get_db, log, notify,
+    get_db, log, log_many, notify,
     get_session, get_latest_prompt, update_prompt_text,
-    message_exists, create_message, get_latest_user_message, upsert_todo_message,
+    get_existing_message_uuids, create_messages, get_latest_user_message, upsert_todo_message,
     compute_state_key, compute_todo_hash, update_session_name_if_empty
 )
 
@@ -25,6 +28,11 @@ DEBOUNCE_SECONDS = int(os.environ.get("DEBOUNCE_SECONDS", 2))
 MAX_OUTPUT_LENGTH = 50000      # Max chars for command output
 MAX_DIFF_LENGTH = 50000         # Max chars for diff content
 MAX_CONTENT_LENGTH = 50000     # Max chars for file content
+DIFF_CONTEXT_LINES = 3         # Unchanged lines shown around each diff hunk
+
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)((?:,\d+)?) \+(\d+)((?:,\d+)?) @@')
+# Substrings marking local slash-command output, which is not stored as a message
+CMD_MARKERS = ('<local-command-stdout>', '<local-command-caveat>', '<command-name>')
 
 
 def truncate_output(text: str, max_length: int) -> tuple[str, bool]:
@@ -36,39 +44,208 @@ def truncate_output(text: str, max_length: int) -> tuple[str, bool]:
     return text[:max_length] + "\n... [truncated]", True
 
 
+def shift_hunk_header(header: str, offset: int) -> str:
+    """Add offset to the old and new start lines of a unified diff hunk header."""
+    return HUNK_HEADER_RE.sub(
+        lambda m: f"@@ -{int(m[1]) + offset}{m[2]} +{int(m[3]) + offset}{m[4]} @@",
+        header, count=1
+    )
+
+
 def generate_diff(old_string: str, new_string: str, file_path: str) -> tuple[str, int, int]:
     """
     Generate unified diff and count lines changed.
     Returns: (diff_text, lines_added, lines_removed)
     """
     try:
-        if not old_string and not new_string:
+        if old_string == new_string or (not old_string and not new_string):
             return "", 0, 0
 
         old_lines = (old_string or "").splitlines(keepends=True)
         new_lines = (new_string or "").splitlines(keepends=True)
 
+        # Trim the common leading and trailing lines (keeping context around the
+        # change) so the quadratic matcher only sees the changed window
+        prefix = 0
+        max_common = min(len(old_lines), len(new_lines))
+        while prefix < max_common and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < max_common - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+            suffix += 1
+        start = max(0, prefix - DIFF_CONTEXT_LINES)
+        trailing = max(0, suffix - DIFF_CONTEXT_LINES)
+
         # Get just the filename for shorter diff headers
         filename = Path(file_path).name if file_path else "file"
 
         diff = difflib.unified_diff(
-            old_lines, new_lines,
+            old_lines[start:len(old_lines) - trailing],
+            new_lines[start:len(new_lines) - trailing],
             fromfile=f"a/{filename}",
             tofile=f"b/{filename}",
-            lineterm=""
+            lineterm="",
+            n=DIFF_CONTEXT_LINES
         )
 
-        diff_text = "".join(diff)
-
-        # Count additions and deletions
-        lines_added = sum(1 for line in diff_text.splitlines() if line.startswith('+') and not line.startswith('+++'))
-        lines_removed = sum(1 for line in diff_text.splitlines() if line.startswith('-') and not line.startswith('---'))
-
-        return diff_text, lines_added, lines_removed
+        # Build the text and count additions/deletions in one pass over the diff
+        parts = []
+        lines_added = lines_removed = 0
+        for index, line in enumerate(diff):
+            if index < 2:  # ---/+++ file headers
+                parts.append(line)
+                continue
+            marker = line[:1]
+            if marker == '+':
+                lines_added += 1
+            elif marker == '-':
+                lines_removed += 1
+            elif marker == '@' and start:
+                # Hunk headers are relative to the window; shift them back to file line numbers
+                line = shift_hunk_header(line, start)
+            parts.append(line)
+
+        return "".join(parts), lines_added, lines_removed
     except Exception as e:
         return f"[Error generating diff: {str(e)}]", 0, 0
 
 
+def build_bash_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Bash: command, description and truncated output."""
+    output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
+    return {
+        **base,
+        'input': {
+            'command': input_data.get('command', ''),
+            'description': input_data.get('description'),
+        },
+        'output': output,
+        'output_truncated': truncated,
+    }
+
+
+def build_edit_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Edit: unified diff of old_string -> new_string with line counts."""
+    old_string = input_data.get('old_string') or ''
+    new_string = input_data.get('new_string') or ''
+    file_path = input_data.get('file_path') or ''
+
+    diff_text, lines_added, lines_removed = generate_diff(old_string, new_string, file_path)
+
+    diff_truncated = False
+    if len(diff_text) > MAX_DIFF_LENGTH:
+        diff_text = "[Diff too large to display]"
+        diff_truncated = True
+
+    return {
+        **base,
+        'input': {
+            'file_path': file_path,
+            'replace_all': input_data.get('replace_all', False),
+        },
+        'diff': diff_text,
+        'lines_added': lines_added,
+        'lines_removed': lines_removed,
+        'diff_truncated': diff_truncated,
+    }
+
+
+def build_read_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Read: don't store file content - just track that the read happened."""
+    return {
+        **base,
+        'input': {
+            'file_path': input_data.get('file_path') or '',
+            'offset': input_data.get('offset'),
+            'limit': input_data.get('limit'),
+        },
+        'output_truncated': len(output_text) > MAX_CONTENT_LENGTH,
+    }
+
+
+def build_write_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Write: truncated file content."""
+    content = input_data.get('content') or ''
+    content, truncated = truncate_output(content, MAX_CONTENT_LENGTH)
+    return {
+        **base,
+        'input': {
+            'file_path': input_data.get('file_path') or '',
+        },
+        'content': content,
+        'content_truncated': truncated,
+    }
+
+
+def build_search_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Grep/Glob: search pattern, options and truncated output."""
+    output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
+    return {
+        **base,
+        'input': {
+            'pattern': input_data.get('pattern') or input_data.get('glob') or '',
+            'path': input_data.get('path'),
+            'glob': input_data.get('glob'),
+            'output_mode': input_data.get('output_mode'),
+        },
+        'output': output,
+        'output_truncated': truncated,
+    }
+
+
+def build_task_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Task: subagent description and truncated output."""
+    output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
+    return {
+        **base,
+        'input': {
+            'description': input_data.get('description') or '',
+            'subagent_type': input_data.get('subagent_type') or '',
+        },
+        'output': output,
+        'output_truncated': truncated,
+    }
+
+
+def build_todo_write_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """TodoWrite: the todo list plus a state_key that changes with any status."""
+    todos = input_data.get('todos') or []
+    if not isinstance(todos, list):
+        todos = []
+    state_key = compute_state_key(todos)
+    return {
+        **base,
+        'input': {
+            'todos': todos,
+        },
+        'state_key': state_key,
+    }
+
+
+def build_generic_json(base: dict, input_data: dict, output_text: str) -> dict:
+    """Generic fallback for other/unknown tools: raw input and truncated output."""
+    output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
+    return {
+        **base,
+        'input': input_data,
+        'output': output,
+        'output_truncated': truncated,
+    }
+
+
+# Tool name -> builder(base, input_data, output_text); unknown tools use build_generic_json
+TOOL_BUILDERS = {
+    'Bash': build_bash_json,
+    'Edit': build_edit_json,
+    'Read': build_read_json,
+    'Write': build_write_json,
+    'Grep': build_search_json,
+    'Glob': build_search_json,
+    'Task': build_task_json,
+    'TodoWrite': build_todo_write_json,
+}
+
+
 def build_tool_json(tool_use: dict, result: dict) -> dict | None:
     """Build the tool JSON structure based on tool type."""
     try:
@@ -84,9 +261,10 @@ def build_tool_json(tool_use: dict, result: dict) -> dict | None:
         output_text = ""
         try:
             if isinstance(result_content, list):
-                for item in result_content:
-                    if isinstance(item, dict) and item.get('type') == 'text':
-                        output_text += item.get('text', '')
+                output_text = ''.join(
+                    item.get('text', '') for item in result_content
+                    if isinstance(item, dict) and item.get('type') == 'text'
+                )
             elif result_content:
                 output_text = str(result_content)
         except Exception:
@@ -98,113 +276,8 @@ def build_tool_json(tool_use: dict, result: dict) -> dict | None:
             'status': 'error' if is_error else 'success',
         }
 
-        if name == 'Bash':
-            output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
-            return {
-                **base,
-                'input': {
-                    'command': input_data.get('command', ''),
-                    'description': input_data.get('description'),
-                },
-                'output': output,
-                'output_truncated': truncated,
-            }
-
-        elif name == 'Edit':
-            old_string = input_data.get('old_string') or ''
-            new_string = input_data.get('new_string') or ''
-            file_path = input_data.get('file_path') or ''
-
-            diff_text, lines_added, lines_removed = generate_diff(old_string, new_string, file_path)
-
-            diff_truncated = False
-            if len(diff_text) > MAX_DIFF_LENGTH:
-                diff_text = "[Diff too large to display]"
-                diff_truncated = True
-
-            return {
-                **base,
-                'input': {
-                    'file_path': file_path,
-                    'replace_all': input_data.get('replace_all', False),
-                },
-                'diff': diff_text,
-                'lines_added': lines_added,
-                'lines_removed': lines_removed,
-                'diff_truncated': diff_truncated,
-            }
-
-        elif name == 'Read':
-            # Don't store file content - just track that the read happened
-            return {
-                **base,
-                'input': {
-                    'file_path': input_data.get('file_path') or '',
-                    'offset': input_data.get('offset'),
-                    'limit': input_data.get('limit'),
-                },
-                'output_truncated': len(output_text) > MAX_CONTENT_LENGTH,
-            }
-
-        elif name == 'Write':
-            content = input_data.get('content') or ''
-            content, truncated = truncate_output(content, MAX_CONTENT_LENGTH)
-            return {
-                **base,
-                'input': {
-                    'file_path': input_data.get('file_path') or '',
-                },
-                'content': content,
-                'content_truncated': truncated,
-            }
-
-        elif name in ('Grep', 'Glob'):
-            output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
-            return {
-                **base,
-                'input': {
-                    'pattern': input_data.get('pattern') or input_data.get('glob') or '',
-                    'path': input_data.get('path'),
-                    'glob': input_data.get('glob'),
-                    'output_mode': input_data.get('output_mode'),
-                },
-                'output': output,
-                'output_truncated': truncated,
-            }
-
-        elif name == 'Task':
-            output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
-            return {
-                **base,
-                'input': {
-                    'description': input_data.get('description') or '',
-                    'subagent_type': input_data.get('subagent_type') or '',
-                },
-                'output': output,
-                'output_truncated': truncated,
-            }
-
-        elif name == 'TodoWrite':
-            todos = input_data.get('todos') or []
-            if not isinstance(todos, list):
-                todos = []
-            state_key = compute_state_key(todos)
-            return {
-                **base,
-                'input': {
-                    'todos': todos,
-                },
-                'state_key': state_key,
-            }
-
-        # Generic fallback for other/unknown tools
-        output, truncated = truncate_output(output_text, MAX_OUTPUT_LENGTH)
-        return {
-            **base,
-            'input': input_data,
-            'output': output,
-            'output_truncated': truncated,
-        }
+        builder = TOOL_BUILDERS.get(name, build_generic_json)
+        return builder(base, input_data, output_text)
 
     except Exception as e:
         return {
@@ -217,17 +290,180 @@ def build_tool_json(tool_use: dict, result: dict) -> dict | None:
         }
 
 
-def process_transcript(conn, session_id: str, transcript_path: str) -> list[dict]:
-    """Process transcript file and store messages. Returns list of new messages."""
+def iter_file_lines(path: Path, start: int = 0) -> Iterator[tuple[bytes, int]]:
+    """Yield (line, next_offset) for the lines of a file from byte offset start.
+
+    Lines are bytes without the trailing newline. next_offset is where the next
+    line begins, or the start of the line itself if it has no newline yet (the
+    writer may still be appending to it), so it is always safe to resume from.
+
+    The file is memory-mapped and split with mmap.find, so only one line is
+    copied out at a time instead of the whole file plus a list of lines.
+    """
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files can't be mapped
+            return
+        with mm:
+            size = len(mm)
+            pos = start
+            while pos < size:
+                end = mm.find(b'\n', pos)
+                if end == -1:
+                    yield mm[pos:size], pos
+                    return
+                yield mm[pos:end], end + 1
+                pos = end + 1
+
+
+def collect_tool_uses(entry: dict, tool_uses: dict, todo_final_states: dict, session_id: str, offset: int = 0) -> None:
+    """Record the tool_use items of an assistant entry, keyed by tool_use_id.
+
+    offset is the byte offset of the entry's line in the transcript.
+    TodoWrite calls also update todo_final_states (todo_hash -> tool_use_id);
+    later entries overwrite earlier ones, so it ends up holding the final state
+    of each todo list.
+    """
+    msg = entry.get('message', {})
+    content_list = msg.get('content', [])
+    if not isinstance(content_list, list):
+        return
+    for item in content_list:
+        if isinstance(item, dict) and item.get('type') == 'tool_use':
+            tool_use_id = item.get('id')
+            if not tool_use_id:
+                continue
+            name = item.get('name')
+            tool_input = item.get('input') or {}
+            if name == 'TodoWrite':
+                todo_hash = compute_todo_hash(session_id, tool_input.get('todos', []))
+                todo_final_states[todo_hash] = tool_use_id
+            tool_uses[tool_use_id] = {
+                'tool_use_id': tool_use_id,
+                'timestamp': entry.get('timestamp'),
+                'name': name,
+                'input': tool_input,
+                'offset': offset
+            }
+
+
+def collect_tool_results(entry: dict, tool_results: dict) -> None:
+    """Record the tool_result items of a user entry, keyed by tool_use_id."""
+    msg = entry.get('message', {})
+    content = msg.get('content', [])
+    if not isinstance(content, list):
+        return
+    for item in content:
+        if isinstance(item, dict) and item.get('type') == 'tool_result':
+            tool_use_id = item.get('tool_use_id')
+            if not tool_use_id:
+                continue
+            tool_results[tool_use_id] = {
+                'content': item.get('content'),
+                'is_error': item.get('is_error', False)
+            }
+            # Capture AskUserQuestion answers if present
+            tool_use_result = entry.get('toolUseResult')
+            if isinstance(tool_use_result, dict) and 'answers' in tool_use_result:
+                tool_results[tool_use_id]['answers'] = tool_use_result['answers']
+
+
+def extract_text_message(entry: dict) -> tuple[str | None, bool, bool, list[dict] | None] | None:
+    """Extract (body, is_thinking, is_user, images) from a user or assistant entry.
+
+    Returns None when the entry has no text or images to store.
+    """
+    entry_type = entry.get('type')
+    message = entry.get('message', {})
+
+    body = None
+    is_thinking = False
+    is_user = False
+    images = None
+
+    # User message - can be string or list with text and image items
+    if entry_type == 'user' and message.get('role') == 'user':
+        content = message.get('content', '')
+        text_parts = []
+        images = []
+
+        if isinstance(content, str) and len(content) > 0:
+            text_parts.append(content)
+        elif isinstance(content, list):
+            # Collect all text items and image items
+            for item in content:
+                if isinstance(item, dict):
+                    item_type = item.get('type')
+                    if item_type == 'text':
+                        text = item.get('text', '')
+                        if text:
+                            text_parts.append(text)
+                    elif item_type == 'image':
+                        source = item.get('source', {})
+                        if source.get('data'):
+                            images.append({
+                                'media_type': source.get('media_type', 'image/png'),
+                                'data': source.get('data')
+                            })
+
+        text_content = '\n'.join(text_parts) if text_parts else None
+
+        if text_content or images:
+            # Skip local command messages
+            if text_content and any(marker in text_content for marker in CMD_MARKERS):
+                return None
+            body = text_content
+            is_user = True
+            images = images or None
+
+    # Assistant message
+    elif entry_type == 'assistant' and message.get('role') == 'assistant' and message.get('type') == 'message':
+        content_list = message.get('content', [])
+        if content_list and len(content_list) > 0:
+            first_content = content_list[0]
+            content_type = first_content.get('type')
+
+            if content_type == 'thinking':
+                body = first_content.get('thinking')
+                is_thinking = True
+            elif content_type == 'text':
+                body = first_content.get('text')
+
+    if body or images:
+        return body, is_thinking, is_user, images
+    return None
+
+
+def process_transcript(conn, session_id: str, transcript_path: str, read_state: dict | None = None) -> list[int]:
+    """Process transcript file and store messages. Returns IDs of new messages.
+
+    read_state is {path, ino, offset} from the previous run (see load_read_state).
+    When it still describes this file, parsing resumes at offset instead of
+    re-reading lines that were already stored; it is updated in place to the end
+    of the last complete line once the transcript has been processed. If an
+    entry failed to process, the offset stops at that entry's line instead, so
+    the next run retries it (already stored rows are skipped by UUID).
+    """
     if not transcript_path:
         log(conn, "No transcript path provided", session_id=session_id)
         return []
 
     transcript_file = Path(transcript_path)
-    if not transcript_file.exists():
+    try:
+        transcript_stat = transcript_file.stat()
+    except FileNotFoundError:
         log(conn, "Transcript file not found", session_id=session_id, path=transcript_path)
         return []
 
+    # Resume after the lines read last time, unless the session moved to another
+    # file or the transcript was replaced or truncated since then
+    start_offset = 0
+    if read_state and (read_state.get('path'), read_state.get('ino')) == (transcript_path, transcript_stat.st_ino):
+        offset = read_state.get('offset')
+        if isinstance(offset, int) and 0 <= offset <= transcript_stat.st_size:
+            start_offset = offset
+
     # Get the latest prompt for this session
     prompt_row = get_latest_prompt(conn, session_id)
 
@@ -237,90 +473,88 @@ def process_transcript(conn, session_id: str, transcript_path: str) -> list[dict
 
     prompt_id = prompt_row['id']
     prompt_text = prompt_row['prompt']
-    new_messages = []
-
-    # Read all entries first for two-pass tool processing
-    entries = []
+    # New messages in transcript order: an ID for upserted TodoWrites, or the
+    # UUID of a row in pending_rows whose ID is known only after the insert
+    new_refs = []
+    # Rows for create_messages, inserted together at the end
+    pending_rows = []
+    first_user_body = None
+
+    # Single streaming pass: collect tool calls, tool results, text messages and
+    # the custom title without keeping parsed entries around.
+    # json.loads accepts bytes, so lines are parsed without a separate decode step
+    tool_uses = {}  # tool_use_id -> {tool_use_id, timestamp, name, input, offset}
+    # Deduplicate TodoWrite entries - keep only the LAST one per todo_hash
+    # This prevents re-emitting all state transitions on reprocessing
+    todo_final_states = {}  # todo_hash -> tool_use_id (latest)
+    tool_results = {}  # tool_use_id -> {content, is_error}
+    text_messages = []  # (uuid, timestamp, body, is_thinking, is_user, images)
+    custom_title = None
+    read_offset = start_offset
+    retry_offsets = []  # line offsets of entries that failed to process
     try:
-        with open(transcript_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
+        for line, next_offset in iter_file_lines(transcript_file, start_offset):
+            line_offset, read_offset = read_offset, next_offset
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:  # JSONDecodeError or invalid UTF-8
+                continue
+
+            entry_type = entry.get('type')
+
+            # Use the last custom-title entry to update the session name
+            if entry_type == 'custom-title':
+                if entry.get('customTitle'):
+                    custom_title = entry.get('customTitle')
+                continue
+
+            if entry_type == 'assistant':
                 try:
-                    entry = json.loads(line)
-                    entries.append(entry)
-                except json.JSONDecodeError:
-                    continue
+                    collect_tool_uses(entry, tool_uses, todo_final_states, session_id, line_offset)
+                except Exception as e:
+                    log(conn, "Error processing assistant entry for tools", session_id=session_id, error=str(e))
+                    retry_offsets.append(line_offset)
+            elif entry_type == 'user':
+                try:
+                    collect_tool_results(entry, tool_results)
+                except Exception as e:
+                    log(conn, "Error processing user entry for tools", session_id=session_id, error=str(e))
+                    retry_offsets.append(line_offset)
+            else:
+                # Other entry types (summaries, snapshots, ...) carry nothing we store
+                continue
+
+            uuid = entry.get('uuid')
+            if uuid:
+                text_message = extract_text_message(entry)
+                if text_message:
+                    text_messages.append((uuid, entry.get('timestamp'), *text_message))
     except IOError as e:
         log(conn, "Error reading transcript file", session_id=session_id, error=str(e))
         return []
 
-    # Pass 1: Collect tool_uses from assistant messages
-    tool_uses = {}  # tool_use_id -> {tool_use_id, timestamp, name, input}
-    for entry in entries:
-        try:
-            if entry.get('type') == 'assistant':
-                msg = entry.get('message', {})
-                content_list = msg.get('content', [])
-                if not isinstance(content_list, list):
-                    continue
-                for item in content_list:
-                    if isinstance(item, dict) and item.get('type') == 'tool_use':
-                        tool_use_id = item.get('id')
-                        if not tool_use_id:
-                            continue
-                        tool_uses[tool_use_id] = {
-                            'tool_use_id': tool_use_id,
-                            'timestamp': entry.get('timestamp'),
-                            'name': item.get('name'),
-                            'input': item.get('input') or {}
-                        }
-        except Exception as e:
-            log(conn, "Error processing assistant entry for tools", session_id=session_id, error=str(e))
-            continue
+    # TodoWrite tool_use_ids that are the final state for their todo_hash -> that hash
+    final_todo_hashes = {tool_use_id: todo_hash for todo_hash, tool_use_id in todo_final_states.items()}
 
-    # Pass 2: Collect tool_results from user messages
-    tool_results = {}  # tool_use_id -> {content, is_error}
-    for entry in entries:
-        try:
-            if entry.get('type') == 'user':
-                msg = entry.get('message', {})
-                content = msg.get('content', [])
-                if isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict) and item.get('type') == 'tool_result':
-                            tool_use_id = item.get('tool_use_id')
-                            if not tool_use_id:
-                                continue
-                            tool_results[tool_use_id] = {
-                                'content': item.get('content'),
-                                'is_error': item.get('is_error', False)
-                            }
-                            # Capture AskUserQuestion answers if present
-                            tool_use_result = entry.get('toolUseResult')
-                            if isinstance(tool_use_result, dict) and 'answers' in tool_use_result:
-                                tool_results[tool_use_id]['answers'] = tool_use_result['answers']
-        except Exception as e:
-            log(conn, "Error processing user entry for tools", session_id=session_id, error=str(e))
-            continue
+    # Look up which tool call and message UUIDs are already stored, in one query
+    existing_uuids = get_existing_message_uuids(
+        conn, [*tool_uses, *(text_message[0] for text_message in text_messages)]
+    )
 
-    # Pass 2.5: Deduplicate TodoWrite entries - keep only the LAST one per todo_hash
-    # This prevents re-emitting all state transitions on reprocessing
-    todo_final_states = {}  # todo_hash -> tool_use_id (latest)
-    for tool_use_id, tool_use in tool_uses.items():
-        if tool_use.get('name') == 'TodoWrite':
-            todos = tool_use.get('input', {}).get('todos', [])
-            todo_hash = compute_todo_hash(session_id, todos)
-            # Later entries overwrite earlier ones, so we keep the final state
-            todo_final_states[todo_hash] = tool_use_id
-
-    # Set of TodoWrite tool_use_ids that are the final state for their todo_hash
-    final_todo_ids = set(todo_final_states.values())
-
-    # Pass 3: Process matched tool calls and create tool messages
+    # Process matched tool calls and create tool messages
     for tool_use_id, tool_use in tool_uses.items():
         try:
+            tool_name = tool_use.get('name')
+            if tool_name == 'TodoWrite':
+                # Skip non-final TodoWrite entries (we only process the last one per todo_hash)
+                if tool_use_id not in final_todo_hashes:
+                    continue
+            elif tool_use_id in existing_uuids:
+                # Regular tool call - skip if already exists
+                continue
+
             result = tool_results.get(tool_use_id, {})
             tool_json = build_tool_json(tool_use, result)
 
@@ -332,161 +566,57 @@ def process_transcript(conn, session_id: str, transcript_path: str) -> list[dict
             if answers:
                 tool_json['answers'] = answers
 
-            tool_name = tool_use.get('name')
             tools_str = json.dumps(tool_json)
+            timestamp = tool_use.get('timestamp')
 
             if tool_name == 'TodoWrite':
-                # Skip non-final TodoWrite entries (we only process the last one per todo_hash)
-                if tool_use_id not in final_todo_ids:
-                    continue
-
                 # TodoWrite uses upsert - updates existing or creates new based on content hash
-                todos = tool_use.get('input', {}).get('todos', [])
-                state_key = tool_json.get('state_key', '')
-                msg_id, todo_id, is_new, state_changed = upsert_todo_message(
+                msg_id, _todo_id, is_new, state_changed = upsert_todo_message(
                     conn,
                     session_id=session_id,
                     prompt_id=prompt_id,
                     uuid=tool_use_id,
-                    created_at=tool_use.get('timestamp'),
+                    created_at=timestamp,
                     tools=tools_str,
-                    todos=todos,
-                    state_key=state_key
+                    todos=tool_use['input'].get('todos', []),
+                    state_key=tool_json.get('state_key', ''),
+                    todo_hash=final_todo_hashes[tool_use_id]
                 )
                 # Emit if message was created (is_new) or updated (state_changed)
                 if is_new or state_changed:
-                    new_messages.append({
-                        'id': msg_id,
-                        'prompt_id': prompt_id,
-                        'uuid': tool_use_id,
-                        'is_user': False,
-                        'thinking': False,
-                        'todo_id': todo_id,
-                        'body': None,
-                        'tools': tool_json,
-                        'created_at': tool_use.get('timestamp'),
-                        'prompt_text': None,
-                    })
+                    new_refs.append(msg_id)
             else:
-                # Regular tool call - skip if already exists
-                if message_exists(conn, tool_use_id):
-                    continue
-
-                msg_id = create_message(
-                    conn, prompt_id,
-                    uuid=tool_use_id,
-                    created_at=tool_use.get('timestamp'),
-                    body=None,
-                    is_thinking=False,
-                    is_user=False,
-                    tools=tools_str
-                )
-                new_messages.append({
-                    'id': msg_id,
-                    'prompt_id': prompt_id,
-                    'uuid': tool_use_id,
-                    'is_user': False,
-                    'thinking': False,
-                    'todo_id': None,
-                    'body': None,
-                    'tools': tool_json,
-                    'created_at': tool_use.get('timestamp'),
-                    'prompt_text': None,
-                })
+                pending_rows.append((
+                    prompt_id, tool_use_id, timestamp,
+                    None, False, False, tools_str, None, None
+                ))
+                new_refs.append(tool_use_id)
         except Exception as e:
             log(conn, "Error processing tool call", session_id=session_id, tool_id=tool_use_id, error=str(e))
+            retry_offsets.append(tool_use['offset'])
             continue
 
-    # Pass 4: Process text messages (user and assistant)
-    for entry in entries:
-        entry_type = entry.get('type')
-        message = entry.get('message', {})
-        uuid = entry.get('uuid')
-        timestamp = entry.get('timestamp')
-
-        if not uuid:
-            continue
-
-        # Check if message already exists
-        if message_exists(conn, uuid):
+    # Store text messages (user and assistant) that aren't stored yet
+    for uuid, timestamp, body, is_thinking, is_user, images in text_messages:
+        if uuid in existing_uuids:
             continue
 
-        body = None
-        is_thinking = False
-        is_user = False
-        images_json = None
-
-        # User message - can be string or list with text and image items
-        if entry_type == 'user' and message.get('role') == 'user':
-            content = message.get('content', '')
-            text_parts = []
-            images = []
-
-            if isinstance(content, str) and len(content) > 0:
-                text_parts.append(content)
-            elif isinstance(content, list):
-                # Collect all text items and image items
-                for item in content:
-                    if isinstance(item, dict):
-                        item_type = item.get('type')
-                        if item_type == 'text':
-                            text = item.get('text', '')
-                            if text:
-                                text_parts.append(text)
-                        elif item_type == 'image':
-                            source = item.get('source', {})
-                            if source.get('data'):
-                                images.append({
-                                    'media_type': source.get('media_type', 'image/png'),
-                                    'data': source.get('data')
-                                })
-
-            text_content = '\n'.join(text_parts) if text_parts else None
-
-            if text_content or images:
-                # Skip local command messages
-                if text_content and ('<local-command-stdout>' in text_content or '<local-command-caveat>' in text_content or '<command-name>' in text_content):
-                    continue
-                body = text_content
-                is_user = True
-                if images:
-                    images_json = json.dumps(images)
-
-        # Assistant message
-        elif entry_type == 'assistant' and message.get('role') == 'assistant' and message.get('type') == 'message':
-            content_list = message.get('content', [])
-            if content_list and len(content_list) > 0:
-                first_content = content_list[0]
-                content_type = first_content.get('type')
-
-                if content_type == 'thinking':
-                    body = first_content.get('thinking')
-                    is_thinking = True
-                elif content_type == 'text':
-                    body = first_content.get('text')
-
-        # Store message if we have body or images
-        if body or images_json:
-            msg_id = create_message(conn, prompt_id, uuid, timestamp, body, is_thinking, is_user, images=images_json)
-            new_messages.append({
-                'id': msg_id,
-                'prompt_id': prompt_id,
-                'uuid': uuid,
-                'is_user': is_user,
-                'thinking': is_thinking,
-                'todo_id': None,
-                'body': body,
-                'tools': None,
-                'images': json.loads(images_json) if images_json else None,
-                'created_at': timestamp,
-                'prompt_text': prompt_text if is_user else None,
-            })
-
-    # Check for custom-title entry to update session name (use the last one)
-    custom_title = None
-    for entry in entries:
-        if entry.get('type') == 'custom-title' and entry.get('customTitle'):
-            custom_title = entry.get('customTitle')
+        images_json = json.dumps(images) if images else None
+        pending_rows.append((prompt_id, uuid, timestamp, body, is_thinking, is_user, None, None, images_json))
+        new_refs.append(uuid)
+        if is_user and body and first_user_body is None:
+            first_user_body = body
+
+    # Insert all new tool and text messages in one statement. Rows whose UUID
+    # was already stored (or repeated in the transcript) come back without an id.
+    inserted_ids = create_messages(conn, pending_rows)
+    new_ids = []
+    for ref in new_refs:
+        msg_id = inserted_ids.pop(ref, None) if isinstance(ref, str) else ref
+        if msg_id is not None:
+            new_ids.append(msg_id)
+
+    # Update session name from the last custom-title entry
     if custom_title:
         cur = conn.cursor()
         cur.execute(
@@ -494,166 +624,263 @@ def process_transcript(conn, session_id: str, transcript_path: str) -> list[dict
             (custom_title, session_id)
         )
     else:
-        # Fall back to first user message body as session name
-        first_user_body = next(
-            (m['body'] for m in new_messages if m['is_user'] and m['body']),
-            None
-        )
+        # Fall back to first new user message body as session name
         if first_user_body:
             update_session_name_if_empty(conn, session_id, first_user_body)
 
-    log(conn, "Processed transcript", session_id=session_id, messages_added=len(new_messages))
-
-    # If latest prompt has no prompt text, set it to newest user message
-    latest_prompt = get_latest_prompt(conn, session_id)
+    log(conn, "Processed transcript", session_id=session_id, messages_added=len(new_ids))
 
-    if latest_prompt and not latest_prompt['prompt']:
-        user_msg = get_latest_user_message(conn, latest_prompt['id'])
+    # If the prompt these messages were stored under has no text, set it to
+    # the newest user message
+    if not prompt_text:
+        user_msg = get_latest_user_message(conn, prompt_id)
 
         if user_msg:
-            update_prompt_text(conn, latest_prompt['id'], user_msg['body'])
+            update_prompt_text(conn, prompt_id, user_msg['body'])
             log(conn, "Set prompt from user message", session_id=session_id)
 
-    return new_messages
+    if read_state is not None:
+        read_state.update(path=transcript_path, ino=transcript_stat.st_ino, offset=min(retry_offsets, default=read_offset))
 
+    return new_ids
 
-def process_session(session_id: str, timestamp: str) -> None:
-    """Process a session job after debounce period."""
-    conn = None
+
+def read_marker(marker_file: Path) -> tuple[os.stat_result, dict]:
+    """Read a debounce marker and return its stat and parsed contents.
+
+    The stat comes from the same descriptor as the contents, so it identifies
+    exactly the file that was read even if a writer replaces the marker meanwhile.
+    Raises FileNotFoundError if there is no marker.
+    """
+    fd = os.open(marker_file, os.O_RDONLY)
+    try:
+        marker_stat = os.fstat(fd)
+        data = os.read(fd, marker_stat.st_size)
+    finally:
+        os.close(fd)
+    return marker_stat, json.loads(data)
+
+
+def acquire_lock(lock_file: Path, on_wait=None) -> int:
+    """Take an exclusive flock on lock_file and return its file descriptor.
+
+    Blocks until the current holder releases it. The kernel drops the lock when
+    its holder exits, so a crashed worker never leaves a stale lock behind.
+    on_wait is called once if the lock is busy.
+    """
+    while True:
+        fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if on_wait:
+                    on_wait()
+                    on_wait = None
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder unlinks the file on release; if that happened
+            # while we waited, our lock is on an orphaned inode - retry on the new file
+            try:
+                if os.fstat(fd).st_ino == os.stat(lock_file).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def release_lock(lock_file: Path, fd: int) -> None:
+    """Remove lock_file and release the flock taken by acquire_lock."""
     try:
-        conn = get_db()
+        lock_file.unlink(missing_ok=True)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def load_read_state(state_file: Path) -> dict:
+    """Load the transcript read position saved by save_read_state.
 
-        log(conn, "Worker started", session_id=session_id, timestamp=timestamp)
+    Returns an empty dict if there is none, which makes process_transcript read
+    the whole file.
+    """
+    try:
+        state = json.loads(state_file.read_text())
+    except FileNotFoundError:
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_read_state(state_file: Path, state: dict) -> None:
+    """Atomically write the transcript read position for the next worker."""
+    tmp_file = state_file.with_name(f"{state_file.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(state))
+    os.replace(tmp_file, state_file)
+
+
+def process_session(session_id: str, timestamp_ns: int) -> None:
+    """Process a session job after debounce period.
+
+    timestamp_ns is the event time (time.time_ns()) this worker was spawned for.
+    """
+    conn = None
+    # Worker log entries are buffered and written together at each commit
+    pending_logs: list[dict] = []
+    written = 0  # how many pending_logs are already in the open transaction
+
+    def wlog(message: str, **kwargs) -> None:
+        pending_logs.append({"message": message, "session_id": session_id, **kwargs})
+
+    def flush_logs() -> None:
+        nonlocal written
+        log_many(conn, pending_logs[written:])
+        written = len(pending_logs)
+
+    def commit() -> None:
+        nonlocal written
+        flush_logs()
         conn.commit()
+        pending_logs.clear()
+        written = 0
+
+    try:
+        marker_file = DEBOUNCE_DIR / f"{session_id}.marker"
+
+        # Peek at the marker before sleeping: if a newer event already replaced
+        # ours, that event's worker will handle the session, so exit without
+        # sleeping or opening a DB connection
+        try:
+            if read_marker(marker_file)[1].get('latest_ns') != timestamp_ns:
+                return
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            pass  # Logged after the sleep
 
         # Sleep for debounce period
         time.sleep(DEBOUNCE_SECONDS)
 
-        # Check if our timestamp is still current
-        marker_file = DEBOUNCE_DIR / f"{session_id}.marker"
+        # Everything the worker writes can be rebuilt from the transcript
+        conn = get_db(synchronous_commit=False)
 
-        if not marker_file.exists():
-            log(conn, "Marker file not found, skipping", session_id=session_id)
-            conn.commit()
-            conn.close()
-            return
+        wlog("Worker started", timestamp_ns=timestamp_ns)
 
+        # Check if our timestamp is still current
         try:
-            marker_data = json.loads(marker_file.read_text())
-            start_timestamp = marker_data.get('start', '')
-            latest_timestamp = marker_data.get('latest', '')
+            # marker_stat identifies this version of the marker for the cleanup below
+            marker_stat, marker_data = read_marker(marker_file)
+            start_ns = marker_data.get('start_ns')
+            latest_ns = marker_data.get('latest_ns')
+        except FileNotFoundError:
+            wlog("Marker file not found, skipping")
+            commit()
+            return
         except (json.JSONDecodeError, KeyError):
-            log(conn, "Invalid marker file, skipping", session_id=session_id)
-            conn.commit()
-            conn.close()
+            wlog("Invalid marker file, skipping")
+            commit()
             return
 
         # Check if we're the latest event
-        is_latest = (latest_timestamp == timestamp)
+        is_latest = (latest_ns == timestamp_ns)
 
         # Check if debounce period has passed since start
         try:
-            start_time = datetime.fromisoformat(start_timestamp)
-            elapsed = (datetime.now() - start_time).total_seconds()
-            debounce_expired = elapsed >= DEBOUNCE_SECONDS
-        except ValueError:
+            debounce_expired = time.time_ns() - start_ns >= DEBOUNCE_SECONDS * 1_000_000_000
+        except TypeError:  # Missing or non-integer start_ns
             debounce_expired = False
 
         if not is_latest and not debounce_expired:
             # Newer event came in and debounce hasn't expired, let that one handle it
-            log(conn, "Newer event detected, skipping", session_id=session_id, our_timestamp=timestamp, latest_timestamp=latest_timestamp)
-            conn.commit()
-            conn.close()
+            wlog("Newer event detected, skipping", our_timestamp_ns=timestamp_ns, latest_timestamp_ns=latest_ns)
+            commit()
             return
 
         # Wait for lock if another worker is processing
         lock_file = DEBOUNCE_DIR / f"{session_id}.lock"
-        lock_timeout = DEBOUNCE_SECONDS * 30  # Stale lock timeout
-        lock_wait_interval = 1  # Check every second
 
-        while lock_file.exists():
-            try:
-                lock_time = datetime.fromisoformat(lock_file.read_text().strip())
-                lock_age = (datetime.now() - lock_time).total_seconds()
-                if lock_age >= lock_timeout:
-                    # Lock is stale, remove it and break
-                    lock_file.unlink()
-                    break
-                # Wait and retry
-                log(conn, "Waiting for lock", session_id=session_id, lock_age=lock_age)
-                conn.commit()
-                time.sleep(lock_wait_interval)
-            except (ValueError, FileNotFoundError):
-                break
-
-        # Acquire lock
-        lock_file.write_text(datetime.now().isoformat())
+        lock_fd = acquire_lock(lock_file, on_wait=lambda: wlog("Waiting for lock"))
 
         try:
             # Re-check marker after acquiring lock - a newer worker may have processed already
             if not marker_file.exists():
-                log(conn, "Marker file gone after lock acquired, skipping", session_id=session_id)
-                conn.commit()
-                conn.close()
+                wlog("Marker file gone after lock acquired, skipping")
+                commit()
                 return
 
             # We're either the latest OR debounce has expired - process the job
-            log(conn, "Debounced job processing", session_id=session_id, is_latest=is_latest, debounce_expired=debounce_expired)
+            wlog("Debounced job processing", is_latest=is_latest, debounce_expired=debounce_expired)
 
             # Get transcript_path from session
             session = get_session(conn, session_id)
 
+            read_state = None
             if session and session['transcript_path']:
-                new_messages = process_transcript(conn, session_id, session['transcript_path'])
+                # Where the previous worker stopped reading; only advanced after commit
+                read_state_file = DEBOUNCE_DIR / f"{session_id}.offset"
+                try:
+                    read_state = load_read_state(read_state_file)
+                except json.JSONDecodeError:
+                    wlog("Invalid read state file, reading whole transcript")
+                    read_state = {}
+                # Keep worker entries ahead of the ones process_transcript writes
+                flush_logs()
+                message_ids = process_transcript(conn, session_id, session['transcript_path'], read_state)
                 # Notify frontend of new messages via PostgreSQL NOTIFY
-                if new_messages:
-                    message_ids = [m['id'] for m in new_messages]
+                if message_ids:
                     notify(conn, "session_update", {
                         "session_id": session_id,
                         "message_ids": message_ids,
                     })
             else:
-                log(conn, "No transcript path in session", session_id=session_id)
-
-            log(conn, "Debounced job completed", session_id=session_id)
-            conn.commit()
-            conn.close()
-
-            # Clean up marker file only if no new events came in during processing
+                wlog("No transcript path in session")
+
+            wlog("Debounced job completed")
+            commit()
+
+            if session and session['status'] == 'ended':
+                # No more events follow SessionEnd, so drop the read position here rather
+                # than leave it to the stale-file sweep; a resumed session rereads the
+                # transcript and skips stored messages by uuid
+                (DEBOUNCE_DIR / f"{session_id}.offset").unlink(missing_ok=True)
+            elif read_state:
+                save_read_state(read_state_file, read_state)
+
+            # Clean up marker file only if no new events came in during processing.
+            # Writers replace the marker with a new file, so an unchanged inode
+            # and mtime mean it is still the one we read
             try:
-                current_marker = json.loads(marker_file.read_text())
-                if current_marker.get('latest') == latest_timestamp:
-                    # No new events - safe to delete
+                current_stat = marker_file.stat()
+                if (current_stat.st_ino, current_stat.st_mtime_ns) == (marker_stat.st_ino, marker_stat.st_mtime_ns):
                     marker_file.unlink()
-                else:
-                    # New event arrived during processing - leave marker for that worker
-                    pass
-            except (FileNotFoundError, json.JSONDecodeError):
-                pass
-        finally:
-            # Release lock
-            try:
-                lock_file.unlink()
             except FileNotFoundError:
                 pass
+        finally:
+            release_lock(lock_file, lock_fd)
 
     except Exception as e:
         # Log error to database if connection exists
         if conn:
             try:
-                log(conn, "Worker error", error=str(e), error_type=type(e).__name__, session_id=session_id)
-                conn.commit()
-                conn.close()
+                # Drop the failed run's writes but keep its log entries
+                conn.rollback()
+                written = 0
+                wlog("Worker error", error=str(e), error_type=type(e).__name__)
+                commit()
             except Exception:
                 pass
         raise RuntimeError("Worker failed") from e
+    finally:
+        if conn:
+            conn.close()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: worker.py <session_id> <timestamp>", file=sys.stderr)
+        print("Usage: worker.py <session_id> <timestamp_ns>", file=sys.stderr)
         sys.exit(1)
 
     session_id = sys.argv[1]
-    timestamp = sys.argv[2]
-    process_session(session_id, timestamp)
+    timestamp_ns = int(sys.argv[2])
+    process_session(session_id, timestamp_ns)